@@ -0,0 +1,284 @@
+from typing import Any
+import tracemalloc
+import random
+import time
+import sys
+
+import orjson
+
+from upd05_group_by_filename import (
+    add_file_info_from_update,
+    compact_file_info_data,
+    file_info_data_shared_objects,
+    get_file_info_type,
+    merge_file_info,
+    update_file_info,
+)
+import by_filename_storage
+import by_update_index
+import build_diff
+import config
+
+
+def get_largest_file_info_names(count: int):
+    catalog = by_filename_storage.read_file_info_catalog()
+    names = sorted(catalog, key=lambda name: catalog[name]['size'], reverse=True)
+    return names[:count]
+
+
+def get_add_file_info_from_update_calls(data: dict[str, Any]):
+    # Reconstruct the calls which created the data. As in upd05, objects are
+    # shared per update and per assembly, but not with the data itself.
+    calls = []
+    update_infos = {}
+    assembly_identities = {}
+
+    for file_hash, file_hash_data in data.items():
+        for windows_version, updates in file_hash_data['windowsVersions'].items():
+            for update_kb, update in updates.items():
+                if update_kb == 'BASE':
+                    continue
+
+                update_info = update_infos.setdefault(update_kb, orjson.loads(orjson.dumps(update['updateInfo'])))
+
+                for manifest_name, assembly in update['assemblies'].items():
+                    assembly_identity = assembly_identities.setdefault(
+                        (update_kb, manifest_name), orjson.loads(orjson.dumps(assembly['assemblyIdentity'])))
+
+                    for attributes in assembly['attributes']:
+                        calls.append({
+                            'file_hash': file_hash,
+                            'virustotal_file_info': None,
+                            'windows_version': windows_version,
+                            'update_kb': update_kb,
+                            'update_info': update_info,
+                            'manifest_name': manifest_name,
+                            'assembly_identity': assembly_identity,
+                            'attributes': dict(attributes),
+                            'delta_or_pe_file_info': file_hash_data.get('fileInfo'),
+                        })
+
+    return calls
+
+
+def benchmark_add_file_info_from_update(count: int):
+    for name in get_largest_file_info_names(count):
+        data = by_filename_storage.read_file_info(name)
+        calls = get_add_file_info_from_update_calls(data)
+
+        results = []
+        for use_index in [False, True]:
+            result = {}
+            attributes_index = {} if use_index else None
+
+            start = time.perf_counter()
+
+            # The second round adds existing items, as when an update is
+            # processed again after an interruption.
+            for _ in range(2):
+                for call in calls:
+                    add_file_info_from_update(result, **call, attributes_index=attributes_index)
+
+            results.append((time.perf_counter() - start, orjson.dumps(result)))
+
+        (time_without_index, result_without_index), (time_with_index, result_with_index) = results
+        assert result_with_index == result_without_index, name
+
+        print(f'{name}: {len(calls)} items,'
+              f' without index: {time_without_index:.3f}s,'
+              f' with index: {time_with_index:.3f}s')
+
+
+def benchmark_compression(count: int):
+    import zstandard
+
+    names = by_filename_storage.get_file_info_names()
+    random.Random(0).shuffle(names)
+
+    def read_data_bytes(name):
+        return by_filename_storage.read_compressed_file(by_filename_storage.get_file_info_path(name))
+
+    # The dictionary is trained on other files than the ones it's tested on.
+    samples = [read_data_bytes(name) for name in names[:count]]
+
+    max_training_size = config.by_filename_zstd_dictionary_samples_mb * 1024 * 1024
+    training_samples = []
+    training_size = 0
+    for name in names[count:]:
+        data_bytes = read_data_bytes(name)
+        if training_size + len(data_bytes) > max_training_size:
+            continue
+
+        training_samples.append(data_bytes)
+        training_size += len(data_bytes)
+
+    dictionary = zstandard.ZstdCompressionDict(by_filename_storage.train_zstd_dictionary(training_samples))
+
+    zstd_compressor = zstandard.ZstdCompressor(level=config.by_filename_zstd_level)
+    zstd_decompressor = zstandard.ZstdDecompressor()
+    zstd_dictionary_compressor = zstandard.ZstdCompressor(level=config.by_filename_zstd_level, dict_data=dictionary)
+    zstd_dictionary_decompressor = zstandard.ZstdDecompressor(dict_data=dictionary)
+
+    codecs = {
+        'gzip': (by_filename_storage.gzip_compress, by_filename_storage.gzip_decompress),
+        'zstd': (zstd_compressor.compress, zstd_decompressor.decompress),
+        'zstd+dictionary': (zstd_dictionary_compressor.compress, zstd_dictionary_decompressor.decompress),
+    }
+
+    size = sum(len(data_bytes) for data_bytes in samples)
+    print(f'{len(samples)} files, {size} bytes, dictionary trained on {len(training_samples)} files')
+
+    for codec_name, (compress, decompress) in codecs.items():
+        start = time.perf_counter()
+        compressed = [compress(data_bytes) for data_bytes in samples]
+        compress_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        decompressed = [decompress(data_compressed) for data_compressed in compressed]
+        decompress_time = time.perf_counter() - start
+
+        assert decompressed == samples, codec_name
+
+        compressed_size = sum(len(data_compressed) for data_compressed in compressed)
+        print(f'{codec_name}: {compressed_size} bytes ({compressed_size / size:.1%}),'
+              f' compression: {size / compress_time / 1024 / 1024:.1f} MB/s,'
+              f' decompression: {size / decompress_time / 1024 / 1024:.1f} MB/s')
+
+
+def get_update_file_info_calls(data: dict[str, Any]):
+    calls = []
+
+    for file_hash_data in data.values():
+        file_info = file_hash_data.get('fileInfo')
+        if not file_info:
+            continue
+
+        # The same info again, as for a file which is part of many updates.
+        calls.append((file_info, dict(file_info), 'update'))
+
+        # Delta info, as for a file which already has full info.
+        if get_file_info_type(file_info) in ['vt_or_file', 'file_unknown_sig']:
+            delta_file_info = {
+                'size': file_info['size'],
+                'machineType': file_info['machineType'],
+                'timestamp': file_info['timestamp'],
+                'lastSectionVirtualAddress': 0,
+                'lastSectionPointerToRawData': 0,
+                'sha256': file_info['sha256'],
+            }
+            calls.append((file_info, delta_file_info, 'update'))
+
+    return calls
+
+
+def benchmark_update_file_info(count: int):
+    calls = []
+    for name in get_largest_file_info_names(count):
+        calls += get_update_file_info_calls(by_filename_storage.read_file_info(name))
+
+    results = []
+    for function in [merge_file_info, update_file_info]:
+        start = time.perf_counter()
+        result = [function(*call) for call in calls]
+        results.append((time.perf_counter() - start, result))
+
+    (time_full, result_full), (time_fast, result_fast) = results
+
+    # Differential check, the fast paths must give exactly the same results.
+    for call, file_info_full, file_info_fast in zip(calls, result_full, result_fast):
+        assert orjson.dumps(file_info_full) == orjson.dumps(file_info_fast), call
+
+    print(f'{len(calls)} merges, full merge: {time_full:.3f}s, with fast paths: {time_fast:.3f}s')
+
+
+def benchmark_memory(count: int):
+    samples = [by_filename_storage.read_compressed_file(by_filename_storage.get_file_info_path(name))
+               for name in get_largest_file_info_names(count)]
+
+    size = sum(len(data_bytes) for data_bytes in samples)
+    print(f'{len(samples)} files, {size} bytes')
+
+    for compact in [False, True]:
+        file_info_data_shared_objects.clear()
+
+        tracemalloc.start()
+
+        all_data = []
+        for data_bytes in samples:
+            data = orjson.loads(data_bytes)
+            if compact:
+                compact_file_info_data(data)
+
+            all_data.append(data)
+
+        memory_size, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        # The compact data must serialize to exactly the same bytes.
+        assert [orjson.dumps(data) for data in all_data] == samples
+
+        print(f'{"compact" if compact else "dict"}: {memory_size / 1024 / 1024:.1f} MB')
+
+    file_info_data_shared_objects.clear()
+
+
+def get_update_files_from_data(update_kbs: list[str]):
+    # The files of the updates without the update index, by reading all data.
+    files_of_updates = {update_kb: {} for update_kb in update_kbs}
+    for name in by_filename_storage.get_file_info_names(by_filename_storage.read_file_info_catalog_for_reader()):
+        data = by_filename_storage.read_file_info_for_reader(name)
+        for file_hash, file_hash_data in data.items():
+            for updates in file_hash_data['windowsVersions'].values():
+                for update_kb in updates.keys() & files_of_updates.keys():
+                    files_of_updates[update_kb].setdefault(name, set()).add(file_hash)
+
+    return files_of_updates
+
+
+def benchmark_build_diff(count: int):
+    # Consecutive updates, the latest ones.
+    update_kbs = sorted(by_update_index.get_update_kbs(),
+                        key=lambda update_kb: by_update_index.read_update_index(update_kb)['created'])
+    update_kbs = update_kbs[-count - 1:]
+
+    for from_update_kb, to_update_kb in zip(update_kbs, update_kbs[1:]):
+        start = time.perf_counter()
+        diff_with_index = list(build_diff.iter_build_diff(from_update_kb, to_update_kb))
+        time_with_index = time.perf_counter() - start
+
+        start = time.perf_counter()
+        files_of_updates = get_update_files_from_data([from_update_kb, to_update_kb])
+        diff_from_data = list(build_diff.iter_files_diff(files_of_updates[from_update_kb],
+                                                         files_of_updates[to_update_kb]))
+        time_from_data = time.perf_counter() - start
+
+        # Differential check, the index must give exactly the same diff.
+        assert orjson.dumps(diff_with_index) == orjson.dumps(diff_from_data), (from_update_kb, to_update_kb)
+
+        print(f'{from_update_kb} -> {to_update_kb}: {len(diff_with_index)} files changed,'
+              f' from all data: {time_from_data:.3f}s,'
+              f' with update index: {time_with_index:.3f}s')
+
+
+def main():
+    benchmarks = {
+        'add_file_info_from_update': (benchmark_add_file_info_from_update, 10),
+        'build_diff': (benchmark_build_diff, 1),
+        'compression': (benchmark_compression, 1000),
+        'memory': (benchmark_memory, 10),
+        'update_file_info': (benchmark_update_file_info, 100),
+    }
+
+    if len(sys.argv) not in [2, 3] or sys.argv[1] not in benchmarks:
+        print(f'Usage: {sys.argv[0]} {{{",".join(benchmarks)}}} [count_of_files]')
+        sys.exit(1)
+
+    benchmark, count = benchmarks[sys.argv[1]]
+    if len(sys.argv) == 3:
+        count = int(sys.argv[2])
+
+    benchmark(count)
+
+
+if __name__ == '__main__':
+    main()
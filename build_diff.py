@@ -0,0 +1,90 @@
+from typing import Iterable, Any
+import orjson
+import sys
+
+import by_filename_storage
+import by_update_index
+
+# Differences between the files of two updates, from the update index. Only
+# the data of files which differ is read, for their versions and sizes.
+
+
+def get_update_files(update_kb: str) -> dict[str, list[str]]:
+    index = by_update_index.read_update_index(update_kb)
+    if index is None:
+        raise Exception(f'{update_kb} is not in the update index, run "by_update_index.py backfill"')
+
+    return index['files']
+
+
+def get_file_versions(name: str, file_hashes: Iterable[str], data_by_key: dict[str, dict[str, Any]]):
+    versions = []
+    for file_hash in sorted(file_hashes):
+        key = by_filename_storage.get_file_info_read_key(name, file_hash)
+        if key not in data_by_key:
+            data_by_key[key] = by_filename_storage.read_file_info_for_reader(key) or {}
+
+        file_info = data_by_key[key].get(file_hash, {}).get('fileInfo') or {}
+        versions.append({
+            'sha256': file_hash,
+            'version': file_info.get('version'),
+            'size': file_info.get('size'),
+        })
+
+    return versions
+
+
+def iter_files_diff(from_files: dict[str, Iterable[str]], to_files: dict[str, Iterable[str]]):
+    for name in sorted(from_files.keys() | to_files.keys()):
+        from_hashes = set(from_files.get(name, []))
+        to_hashes = set(to_files.get(name, []))
+        if from_hashes == to_hashes:
+            continue
+
+        if not from_hashes:
+            change = 'added'
+        elif not to_hashes:
+            change = 'removed'
+        else:
+            change = 'changed'
+
+        data_by_key = {}
+        yield {
+            'name': name,
+            'change': change,
+            'from': get_file_versions(name, from_hashes, data_by_key),
+            'to': get_file_versions(name, to_hashes, data_by_key),
+        }
+
+
+def iter_build_diff(from_update_kb: str, to_update_kb: str):
+    return iter_files_diff(get_update_files(from_update_kb), get_update_files(to_update_kb))
+
+
+def write_build_diff(fd, from_update_kb: str, to_update_kb: str):
+    # Each file is written as soon as it's compared, the diff isn't kept in
+    # memory.
+    fd.write(b'{"from":' + orjson.dumps(from_update_kb) + b',"to":' + orjson.dumps(to_update_kb) + b',"files":[')
+
+    count = 0
+    separator = b'\n'
+    for item in iter_build_diff(from_update_kb, to_update_kb):
+        fd.write(separator + orjson.dumps(item))
+        separator = b',\n'
+        count += 1
+
+    fd.write(b'\n]}\n')
+
+    return count
+
+
+def main():
+    if len(sys.argv) != 3:
+        print(f'Usage: {sys.argv[0]} <from_update_kb> <to_update_kb>')
+        sys.exit(1)
+
+    write_build_diff(sys.stdout.buffer, sys.argv[1], sys.argv[2])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,1011 @@
+from typing import Optional, Iterable, Any
+from contextlib import contextmanager
+from isal import igzip as gzip
+from pathlib import Path
+import threading
+import tempfile
+import hashlib
+import random
+import shutil
+import orjson
+import sys
+import io
+import os
+
+import config
+
+if sys.platform == 'win32':
+    import msvcrt
+else:
+    import fcntl
+
+# Digests of the decoded data of files as they were read, with the stat of the
+# file at the time. Used to skip writing data which didn't change.
+file_info_digests: dict[str, tuple[bytes, int, int]] = {}
+
+# The stat of files and of their change logs as they were read or written by
+# this process, to detect writes of other processes in between.
+file_info_versions: dict[str, tuple[Optional[tuple[int, int]], int]] = {}
+
+# Locks held by the thread, see lock_file_info().
+file_info_locks = threading.local()
+
+write_counts = {'written': 0, 'skipped': 0}
+write_counts_lock = threading.Lock()
+
+# Names of split files which were checked to be split on disk, see
+# split_file_info_if_needed().
+split_file_info_names: set[str] = set()
+
+# zstd objects aren't thread safe, each thread gets its own.
+zstd_thread_state = threading.local()
+zstd_dictionary = None
+
+
+def gzip_compress(data: bytes):
+    with io.BytesIO() as fd:
+        with gzip.GzipFile(fileobj=fd, mode='w', compresslevel=config.compression_level, filename='', mtime=0) as gz:
+            gz.write(data)
+
+        return fd.getvalue()
+
+
+def gzip_decompress(data: bytes):
+    return gzip.decompress(data)
+
+
+def gzip_write_chunks(fd, chunks: Iterable[bytes]):
+    with gzip.GzipFile(fileobj=fd, mode='w', compresslevel=config.compression_level, filename='', mtime=0) as gz:
+        for chunk in chunks:
+            gz.write(chunk)
+
+
+def get_zstd_dictionary_path():
+    return get_output_dir('zstd').joinpath('dictionary')
+
+
+def get_zstd_dictionary():
+    global zstd_dictionary
+
+    import zstandard
+
+    if zstd_dictionary is None:
+        zstd_dictionary = zstandard.ZstdCompressionDict(get_zstd_dictionary_path().read_bytes())
+
+    return zstd_dictionary
+
+
+def zstd_compress(data: bytes):
+    import zstandard
+
+    if not hasattr(zstd_thread_state, 'compressor'):
+        zstd_thread_state.compressor = zstandard.ZstdCompressor(level=config.by_filename_zstd_level,
+                                                                dict_data=get_zstd_dictionary())
+
+    return zstd_thread_state.compressor.compress(data)
+
+
+def zstd_decompress(data: bytes):
+    import zstandard
+
+    if not hasattr(zstd_thread_state, 'decompressor'):
+        zstd_thread_state.decompressor = zstandard.ZstdDecompressor(dict_data=get_zstd_dictionary())
+
+    # Streamed files have no content size in the frame header.
+    return zstd_thread_state.decompressor.decompressobj().decompress(data)
+
+
+def zstd_write_chunks(fd, chunks: Iterable[bytes]):
+    import zstandard
+
+    compressor = zstandard.ZstdCompressor(level=config.by_filename_zstd_level, dict_data=get_zstd_dictionary())
+    with compressor.stream_writer(fd, closefd=False) as writer:
+        for chunk in chunks:
+            writer.write(chunk)
+
+
+# The website reads the gzip files in by_filename_compressed. The zstd files,
+# compressed with a dictionary trained on the data, are for working copies
+# which aren't published.
+codecs = {
+    'gzip': {
+        'dir': 'by_filename_compressed',
+        'suffix': '.json.gz',
+        'compress': gzip_compress,
+        'decompress': gzip_decompress,
+        'write_chunks': gzip_write_chunks,
+    },
+    'zstd': {
+        'dir': 'by_filename_zstd',
+        'suffix': '.json.zst',
+        'compress': zstd_compress,
+        'decompress': zstd_decompress,
+        'write_chunks': zstd_write_chunks,
+    },
+}
+
+
+def get_codec(codec: Optional[str] = None):
+    return codecs[codec or config.by_filename_codec]
+
+
+def get_output_dir(codec: Optional[str] = None):
+    return config.out_path.joinpath(get_codec(codec)['dir'])
+
+
+def get_changes_dir():
+    return config.out_path.joinpath('by_filename_changes')
+
+
+# Files of names with many hashes can be split into sub-shards by hash prefix,
+# so that only the sub-shards which change are read and written. The data of
+# a sub-shard is stored with the key "<name>/<sub-shard>". The order of the
+# hashes is kept in an index, and the full file of the name is written from
+# the sub-shards by publish_split_file_info().
+def get_sub_shards_dir():
+    return config.out_path.joinpath('by_filename_sub_shards')
+
+
+def is_file_info_split(name: str):
+    return name in config.by_filename_sub_shard_names
+
+
+def get_sub_shard(file_hash: str):
+    return int(file_hash[:8], 16) % config.by_filename_sub_shard_count
+
+
+def get_file_info_key(name: str, file_hash: str):
+    if not is_file_info_split(name):
+        return name
+
+    split_file_info_if_needed(name)
+    return f'{name}/{get_sub_shard(file_hash)}'
+
+
+def get_file_info_fanout_dir(name: str):
+    return hashlib.sha256(name.encode()).hexdigest()[:config.by_filename_fanout_length]
+
+
+def get_file_info_path(key: str, codec: Optional[str] = None, layout: Optional[str] = None):
+    if '/' in key:
+        name, sub_shard = key.split('/')
+        return get_sub_shards_dir().joinpath(name, sub_shard + get_codec(codec)['suffix'])
+
+    output_dir = get_output_dir(codec)
+    if (layout or config.by_filename_layout) == 'fanout':
+        output_dir = output_dir.joinpath(get_file_info_fanout_dir(key))
+
+    return output_dir.joinpath(key + get_codec(codec)['suffix'])
+
+
+def get_file_info_changes_path(key: str):
+    return get_changes_dir().joinpath(f'{key}.jsonl')
+
+
+def get_file_info_hashes_path(name: str):
+    return get_sub_shards_dir().joinpath(name, 'hashes.txt')
+
+
+def get_file_info_unpublished_path(name: str):
+    return get_sub_shards_dir().joinpath(name, 'unpublished')
+
+
+# The catalog has the size, the number of entries and the digest of the data
+# of every file in the output dir, so that files can be listed without listing
+# the directory. Writers append changes to a log as [name, entry] lines, or
+# [name, null] for deleted files, which is safe with several processes writing
+# files. The log is merged into the catalog by compact_file_info_catalog().
+def get_file_info_catalog_path(codec: Optional[str] = None):
+    return config.out_path.joinpath(get_codec(codec)['dir'] + '_catalog.json')
+
+
+def get_file_info_catalog_changes_path(codec: Optional[str] = None):
+    return config.out_path.joinpath(get_codec(codec)['dir'] + '_catalog_changes.jsonl')
+
+
+def get_file_info_catalog_entry(size: int, entry_count: int, digest: bytes):
+    return {
+        'size': size,
+        'entries': entry_count,
+        'digest': digest.hex(),
+    }
+
+
+def write_file_info_catalog(catalog: dict[str, dict[str, Any]], codec: Optional[str] = None):
+    catalog_bytes = orjson.dumps(catalog, option=orjson.OPT_SORT_KEYS)
+    write_file_atomically(get_file_info_catalog_path(codec), lambda fd: fd.write(catalog_bytes))
+
+
+def get_file_info_catalog_from_files():
+    suffix = get_codec()['suffix']
+    pattern = f'*/*{suffix}' if config.by_filename_layout == 'fanout' else f'*{suffix}'
+
+    catalog = {}
+    for path in get_output_dir().glob(pattern):
+        name = path.name.removesuffix(suffix)
+        if get_file_info_changes_path(name).is_file():
+            # The entry is of the data with the changes.
+            data_bytes = orjson.dumps(read_stored_file_info_and_size(name)[0])
+        else:
+            data_bytes = read_compressed_file(path)
+
+        catalog[name] = get_file_info_catalog_entry(
+            path.stat().st_size, len(orjson.loads(data_bytes)), get_data_digest(data_bytes))
+
+    return catalog
+
+
+def build_file_info_catalog():
+    write_file_info_catalog(get_file_info_catalog_from_files())
+    get_file_info_catalog_changes_path().unlink(missing_ok=True)
+
+
+def init_file_info_catalog():
+    # Must be called before files are written by several processes.
+    if not get_file_info_catalog_path().is_file():
+        build_file_info_catalog()
+
+
+def add_file_info_catalog_change(name: str, entry: Optional[dict[str, Any]]):
+    init_file_info_catalog()
+
+    with open(get_file_info_catalog_changes_path(), 'ab') as f:
+        f.write(orjson.dumps([name, entry]) + b'\n')
+
+
+def compact_file_info_catalog(codec: Optional[str] = None):
+    # Returns whether names were added or removed. Changes appended while
+    # compacting are lost, files must not be written by other processes.
+    init_file_info_catalog()
+
+    changes_path = get_file_info_catalog_changes_path(codec)
+    if not changes_path.is_file():
+        return False
+
+    catalog = orjson.loads(get_file_info_catalog_path(codec).read_bytes())
+
+    names_changed = False
+    with open(changes_path, 'rb') as f:
+        for line in f:
+            name, entry = orjson.loads(line)
+            if entry is None:
+                names_changed |= catalog.pop(name, None) is not None
+            else:
+                names_changed |= name not in catalog
+                catalog[name] = entry
+
+    write_file_info_catalog(catalog, codec)
+    changes_path.unlink()
+
+    return names_changed
+
+
+def read_file_info_catalog(codec: Optional[str] = None) -> dict[str, dict[str, Any]]:
+    compact_file_info_catalog(codec)
+    return orjson.loads(get_file_info_catalog_path(codec).read_bytes())
+
+
+def read_file_info_catalog_for_reader() -> dict[str, dict[str, Any]]:
+    # For tools which only read the data. The changes are applied in memory,
+    # the catalog isn't compacted or built.
+    catalog_path = get_file_info_catalog_path()
+    if not catalog_path.is_file():
+        return get_file_info_catalog_from_files()
+
+    catalog = orjson.loads(catalog_path.read_bytes())
+
+    changes_path = get_file_info_catalog_changes_path()
+    if changes_path.is_file():
+        with open(changes_path, 'rb') as f:
+            for line in f:
+                name, entry = orjson.loads(line)
+                if entry is None:
+                    catalog.pop(name, None)
+                else:
+                    catalog[name] = entry
+
+    return catalog
+
+
+def get_file_info_catalog_version(catalog: dict[str, dict[str, Any]]):
+    # Changes when the data of a file changes. The size isn't included, it
+    # changes when the change log of a file is compacted.
+    items = sorted((name, entry['entries'], entry['digest']) for name, entry in catalog.items())
+    return hashlib.sha256(orjson.dumps(items)).hexdigest()
+
+
+def get_file_info_keys(codec: Optional[str] = None):
+    suffix = get_codec(codec)['suffix']
+
+    keys = list(read_file_info_catalog(codec))
+    keys += [f'{path.parent.name}/{path.name.removesuffix(suffix)}'
+             for path in get_sub_shards_dir().glob(f'*/*{suffix}')]
+
+    return keys
+
+
+def get_file_info_names(catalog: Optional[dict[str, dict[str, Any]]] = None):
+    if catalog is None:
+        catalog = read_file_info_catalog()
+
+    names = set(catalog)
+
+    # Split files might not be published yet.
+    names |= {name for name in config.by_filename_sub_shard_names if get_sub_shards_dir().joinpath(name).is_dir()}
+
+    return sorted(names)
+
+
+def fsync_file(fd):
+    if config.by_filename_fsync != 'none':
+        fd.flush()
+        os.fsync(fd.fileno())
+
+
+def fsync_dir(path: Path):
+    # Directories can't be opened on Windows, renames are durable there.
+    if config.by_filename_fsync != 'file_and_dir' or sys.platform == 'win32':
+        return
+
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def write_file_atomically(file: Path, write):
+    # Replace the file only when fully written, an interrupted write must not
+    # leave a truncated file behind. The temp file has a unique name, so that
+    # writers of the same file don't collide. Left over temp files are
+    # removed by deploy before committing.
+    with tempfile.NamedTemporaryFile(dir=file.parent, prefix=file.name + '.', suffix='.tmp', delete=False) as fd:
+        temp_file = Path(fd.name)
+        try:
+            write(fd)
+            fsync_file(fd)
+        except BaseException:
+            fd.close()
+            temp_file.unlink()
+            raise
+
+    temp_file.replace(file)
+    fsync_dir(file.parent)
+
+
+# Advisory locks of storage keys, shared by all processes which use the same
+# lock dir. Readers take a shared lock, so that a file and its change log are
+# read consistently, and writers take an exclusive lock. Keys are hashed to a
+# fixed number of lock files. A thread holds a single lock at a time, nested
+# locks are only allowed for the same lock file.
+def get_file_info_lock_path(key: str):
+    digest = hashlib.sha256(key.encode()).digest()
+    lock_number = int.from_bytes(digest[:4], 'little') % config.by_filename_lock_count
+    return config.by_filename_lock_path.joinpath(f'{lock_number}.lock')
+
+
+def lock_fd(fd, shared: bool):
+    if sys.platform == 'win32':
+        # No shared locks with msvcrt, and LK_LOCK gives up after 10 seconds.
+        fd.seek(0)
+        while True:
+            try:
+                msvcrt.locking(fd.fileno(), msvcrt.LK_LOCK, 1)
+                return
+            except OSError:
+                pass
+    else:
+        fcntl.flock(fd, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+
+
+def unlock_fd(fd):
+    if sys.platform == 'win32':
+        fd.seek(0)
+        msvcrt.locking(fd.fileno(), msvcrt.LK_UNLCK, 1)
+    else:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+
+
+@contextmanager
+def lock_file_info(key: str, shared: bool = False):
+    if not config.by_filename_locking:
+        yield
+        return
+
+    lock_path = get_file_info_lock_path(key)
+
+    held = file_info_locks.__dict__.setdefault('held', {})
+    if lock_path in held:
+        held_shared, count = held[lock_path]
+        assert shared or not held_shared, key
+        held[lock_path] = (held_shared, count + 1)
+        try:
+            yield
+        finally:
+            held[lock_path] = (held_shared, count)
+        return
+
+    assert not held, (key, held)
+
+    config.by_filename_lock_path.mkdir(parents=True, exist_ok=True)
+    with open(lock_path, 'ab') as fd:
+        lock_fd(fd, shared)
+        held[lock_path] = (shared, 1)
+        try:
+            yield
+        finally:
+            del held[lock_path]
+            unlock_fd(fd)
+
+
+def get_file_info_version(key: str):
+    try:
+        stat = get_file_info_path(key).stat()
+        file_stat = (stat.st_mtime_ns, stat.st_size)
+    except FileNotFoundError:
+        file_stat = None
+
+    try:
+        changes_size = get_file_info_changes_path(key).stat().st_size
+    except FileNotFoundError:
+        changes_size = 0
+
+    return file_stat, changes_size
+
+
+def check_file_info_version(key: str):
+    # Writing data which was read before another process wrote the file would
+    # lose the changes of the other process.
+    if key in file_info_versions and get_file_info_version(key) != file_info_versions[key]:
+        raise Exception(f'{key} was changed by another process since it was read')
+
+
+def write_compressed_file(file: Path, data: bytes, codec: Optional[str] = None):
+    data_compressed = get_codec(codec)['compress'](data)
+    write_file_atomically(file, lambda fd: fd.write(data_compressed))
+
+
+def write_compressed_file_chunks(file: Path, chunks: Iterable[bytes], codec: Optional[str] = None):
+    data_hash = hashlib.sha256()
+
+    def hash_chunks():
+        for chunk in chunks:
+            data_hash.update(chunk)
+            yield chunk
+
+    write_file_atomically(file, lambda fd: get_codec(codec)['write_chunks'](fd, hash_chunks()))
+
+    return data_hash.digest()
+
+
+def iter_file_info_json_items(items: dict[str, bytes]):
+    # The same bytes as orjson.dumps() of the data, from items which are
+    # already serialized, without building them all in memory.
+    yield b'{'
+
+    separator = b''
+    for file_hash, value_bytes in items.items():
+        yield separator + orjson.dumps(file_hash) + b':' + value_bytes
+        separator = b','
+
+    yield b'}'
+
+
+def read_compressed_file(file: Path, codec: Optional[str] = None):
+    with open(file, 'rb') as fd:
+        return get_codec(codec)['decompress'](fd.read())
+
+
+def apply_file_info_change(data: dict[str, Any], path: list[str], value: Any):
+    x = data
+    for key in path[:-1]:
+        x = x.setdefault(key, {})
+
+    x[path[-1]] = value
+
+
+def get_data_digest(data_bytes: bytes):
+    return hashlib.sha256(data_bytes).digest()
+
+
+def set_file_info_digest(name: str, data_bytes: bytes):
+    stat = get_file_info_path(name).stat()
+    file_info_digests[name] = (get_data_digest(data_bytes), stat.st_mtime_ns, stat.st_size)
+
+
+def is_file_info_unchanged(name: str, data_bytes: bytes):
+    if name not in file_info_digests:
+        return False
+
+    digest, mtime_ns, size = file_info_digests[name]
+
+    # The file might have been changed by another process since it was read.
+    try:
+        stat = get_file_info_path(name).stat()
+    except FileNotFoundError:
+        return False
+
+    if (stat.st_mtime_ns, stat.st_size) != (mtime_ns, size):
+        return False
+
+    if get_file_info_changes_path(name).exists():
+        return False
+
+    return get_data_digest(data_bytes) == digest
+
+
+def count_write(written: bool):
+    with write_counts_lock:
+        write_counts['written' if written else 'skipped'] += 1
+
+
+def pop_write_counts():
+    with write_counts_lock:
+        counts = dict(write_counts)
+        write_counts.update(dict.fromkeys(write_counts, 0))
+
+    return counts
+
+
+def add_write_counts(counts: dict[str, int]):
+    with write_counts_lock:
+        for key, value in counts.items():
+            write_counts[key] += value
+
+
+def read_file_info_and_size(key: str) -> tuple[Optional[dict[str, Any]], int]:
+    if is_file_info_split(key):
+        return read_split_file_info_and_size(key)
+
+    return read_stored_file_info_and_size(key)
+
+
+def read_stored_file_info_and_size(key: str) -> tuple[Optional[dict[str, Any]], int]:
+    with lock_file_info(key, shared=True):
+        output_path = get_file_info_path(key)
+        if not output_path.is_file():
+            file_info_digests.pop(key, None)
+            file_info_versions[key] = get_file_info_version(key)
+            return None, 0
+
+        data_bytes = read_compressed_file(output_path)
+
+        data = orjson.loads(data_bytes)
+        data_size = len(data_bytes)
+
+        changes_path = get_file_info_changes_path(key)
+        if not changes_path.is_file():
+            set_file_info_digest(key, data_bytes)
+        else:
+            file_info_digests.pop(key, None)
+            with open(changes_path, 'rb') as f:
+                for line in f:
+                    path, value = orjson.loads(line)
+                    apply_file_info_change(data, path, value)
+                    data_size += len(line)
+
+        file_info_versions[key] = get_file_info_version(key)
+
+        return data, data_size
+
+
+def read_file_info(key: str):
+    data, _ = read_file_info_and_size(key)
+    return data
+
+
+# For tools which only read the data. Unlike get_file_info_key() and
+# read_file_info(), files which aren't split on disk yet are read in full
+# instead of being split, so nothing is written.
+def is_file_info_split_on_disk(name: str):
+    return is_file_info_split(name) and get_sub_shards_dir().joinpath(name).is_dir()
+
+
+def get_file_info_read_key(name: str, file_hash: str):
+    if not is_file_info_split_on_disk(name):
+        return name
+
+    return f'{name}/{get_sub_shard(file_hash)}'
+
+
+def read_file_info_for_reader(key: str):
+    if is_file_info_split(key) and not is_file_info_split_on_disk(key):
+        data, _ = read_stored_file_info_and_size(key)
+        return data
+
+    return read_file_info(key)
+
+
+def read_file_info_hashes(name: str):
+    hashes_path = get_file_info_hashes_path(name)
+    if not hashes_path.is_file():
+        return []
+
+    with open(hashes_path) as f:
+        return list(dict.fromkeys(line.rstrip('\n') for line in f))
+
+
+def add_file_info_hashes(name: str, file_hashes: list[str]):
+    if not is_file_info_split(name) or not file_hashes:
+        return
+
+    split_file_info_if_needed(name)
+
+    # New hashes are added before the sub-shards are written, so that the
+    # order is the order in which they were added to the data. Hashes without
+    # data are ignored when reading.
+    with open(get_file_info_hashes_path(name), 'a') as f:
+        f.write(''.join(file_hash + '\n' for file_hash in file_hashes))
+
+
+def read_split_file_info_and_size(name: str):
+    split_file_info_if_needed(name)
+
+    suffix = get_codec()['suffix']
+
+    sub_shards_data = {}
+    data_size = 0
+    for path in get_sub_shards_dir().joinpath(name).glob(f'*{suffix}'):
+        sub_shard_data, sub_shard_size = read_stored_file_info_and_size(f'{name}/{path.name.removesuffix(suffix)}')
+        sub_shards_data |= sub_shard_data
+        data_size += sub_shard_size
+
+    if not sub_shards_data:
+        return None, 0
+
+    data = {}
+    for file_hash in read_file_info_hashes(name):
+        if file_hash in sub_shards_data:
+            data[file_hash] = sub_shards_data.pop(file_hash)
+
+    data |= sub_shards_data
+
+    return data, data_size
+
+
+def split_file_info_if_needed(name: str):
+    if name in split_file_info_names:
+        return
+
+    split_file_info_names.add(name)
+
+    # Split the existing full file on first use.
+    sub_shards_dir = get_sub_shards_dir().joinpath(name)
+    if not sub_shards_dir.is_dir():
+        data, _ = read_stored_file_info_and_size(name)
+        sub_shards_dir.mkdir(parents=True)
+        write_split_file_info(name, data or {})
+
+
+def write_split_file_info(name: str, data: dict[str, Any]):
+    split_file_info_if_needed(name)
+
+    sub_shards_data = {}
+    for file_hash, value in data.items():
+        sub_shards_data.setdefault(str(get_sub_shard(file_hash)), {})[file_hash] = value
+
+    suffix = get_codec()['suffix']
+    for path in get_sub_shards_dir().joinpath(name).glob(f'*{suffix}'):
+        sub_shards_data.setdefault(path.name.removesuffix(suffix), {})
+
+    get_file_info_unpublished_path(name).touch()
+
+    write_file_atomically(get_file_info_hashes_path(name),
+                          lambda fd: fd.write(''.join(file_hash + '\n' for file_hash in data).encode()))
+
+    written_size = 0
+    for sub_shard, sub_shard_data in sub_shards_data.items():
+        key = f'{name}/{sub_shard}'
+        if sub_shard_data:
+            written_size += write_file_info(key, sub_shard_data)
+        else:
+            with lock_file_info(key):
+                check_file_info_version(key)
+                get_file_info_path(key).unlink()
+                get_file_info_changes_path(key).unlink(missing_ok=True)
+                file_info_digests.pop(key, None)
+                file_info_versions.pop(key, None)
+
+    return written_size
+
+
+def read_split_file_info_json_items(name: str):
+    # The serialized items of the file in order, a sub-shard is decoded at a
+    # time. The full file is only kept serialized, which takes much less
+    # memory than decoded.
+    split_file_info_if_needed(name)
+
+    suffix = get_codec()['suffix']
+
+    sub_shards_items = {}
+    for path in get_sub_shards_dir().joinpath(name).glob(f'*{suffix}'):
+        sub_shard_data, _ = read_stored_file_info_and_size(f'{name}/{path.name.removesuffix(suffix)}')
+        for file_hash, value in sub_shard_data.items():
+            sub_shards_items[file_hash] = orjson.dumps(value)
+
+    items = {}
+    for file_hash in read_file_info_hashes(name):
+        if file_hash in sub_shards_items:
+            items[file_hash] = sub_shards_items.pop(file_hash)
+
+    items |= sub_shards_items
+
+    return items
+
+
+def publish_split_file_info():
+    count = 0
+
+    for name in sorted(config.by_filename_sub_shard_names):
+        unpublished_path = get_file_info_unpublished_path(name)
+        if not unpublished_path.is_file():
+            continue
+
+        items = read_split_file_info_json_items(name)
+
+        with lock_file_info(name):
+            output_path = get_file_info_path(name)
+            if items:
+                output_path.parent.mkdir(parents=True, exist_ok=True)
+                digest = write_compressed_file_chunks(output_path, iter_file_info_json_items(items))
+                add_file_info_catalog_change(name, get_file_info_catalog_entry(
+                    output_path.stat().st_size, len(items), digest))
+            elif output_path.is_file():
+                output_path.unlink()
+                add_file_info_catalog_change(name, None)
+
+            # A change log from before the split is included in the sub-shards.
+            get_file_info_changes_path(name).unlink(missing_ok=True)
+            file_info_digests.pop(name, None)
+            file_info_versions.pop(name, None)
+            unpublished_path.unlink()
+        count += 1
+
+    return count
+
+
+def write_file_info(key: str, data: dict[str, Any], data_bytes: Optional[bytes] = None):
+    if is_file_info_split(key):
+        return write_split_file_info(key, data)
+
+    if data_bytes is None:
+        data_bytes = orjson.dumps(data)
+
+    with lock_file_info(key):
+        return write_file_info_locked(key, data, data_bytes)
+
+
+def write_file_info_locked(key: str, data: dict[str, Any], data_bytes: bytes):
+    check_file_info_version(key)
+
+    if is_file_info_unchanged(key, data_bytes):
+        count_write(False)
+        return 0
+
+    if '/' in key:
+        get_file_info_unpublished_path(key.split('/')[0]).touch()
+
+    output_path = get_file_info_path(key)
+    if key not in file_info_digests and not output_path.is_file():
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+
+    write_compressed_file(output_path, data_bytes)
+
+    # The changes are included in the full data now.
+    get_file_info_changes_path(key).unlink(missing_ok=True)
+
+    set_file_info_digest(key, data_bytes)
+    file_info_versions[key] = get_file_info_version(key)
+    count_write(True)
+
+    if '/' not in key:
+        digest, _, size = file_info_digests[key]
+        add_file_info_catalog_change(key, get_file_info_catalog_entry(size, len(data), digest))
+
+    return len(data_bytes)
+
+
+def write_file_info_changes(key: str, data: dict[str, Any], changed_paths: Iterable[tuple[str, ...]]):
+    if not config.by_filename_changes_log or is_file_info_split(key):
+        return write_file_info(key, data)
+
+    with lock_file_info(key):
+        return write_file_info_changes_locked(key, data, changed_paths)
+
+
+def write_file_info_changes_locked(key: str, data: dict[str, Any], changed_paths: Iterable[tuple[str, ...]]):
+    check_file_info_version(key)
+
+    # New files are written in full so that by_filename_compressed always has
+    # an entry for every file.
+    if not get_file_info_path(key).is_file():
+        return write_file_info(key, data)
+
+    data_bytes = orjson.dumps(data)
+    if key in file_info_digests and is_file_info_unchanged(key, data_bytes):
+        count_write(False)
+        return 0
+
+    # Changes are replayed in order, keep the order in which the paths were
+    # first changed to get the same key order as in the full data.
+    changes = b''
+    for path in changed_paths:
+        x = data
+        for path_key in path:
+            x = x[path_key]
+
+        changes += orjson.dumps([path, x]) + b'\n'
+
+    changes_path = get_file_info_changes_path(key)
+    changes_size = changes_path.stat().st_size if changes_path.is_file() else 0
+    if changes_size + len(changes) > config.by_filename_changes_max_size:
+        return write_file_info(key, data)
+
+    if '/' in key:
+        get_file_info_unpublished_path(key.split('/')[0]).touch()
+
+    changes_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(changes_path, 'ab') as f:
+        f.write(changes)
+        fsync_file(f)
+
+    file_info_digests.pop(key, None)
+    file_info_versions[key] = get_file_info_version(key)
+    count_write(True)
+
+    # The catalog has the entries and the digest of the data with the changes.
+    if '/' not in key:
+        add_file_info_catalog_change(key, get_file_info_catalog_entry(
+            get_file_info_path(key).stat().st_size, len(data), get_data_digest(data_bytes)))
+
+    return len(changes)
+
+
+def delete_file_info(name: str):
+    if is_file_info_split(name):
+        shutil.rmtree(get_sub_shards_dir().joinpath(name), ignore_errors=True)
+        shutil.rmtree(get_changes_dir().joinpath(name), ignore_errors=True)
+        split_file_info_names.discard(name)
+        for key in [key for key in file_info_digests if key.startswith(f'{name}/')]:
+            del file_info_digests[key]
+        for key in [key for key in file_info_versions if key.startswith(f'{name}/')]:
+            del file_info_versions[key]
+
+    with lock_file_info(name):
+        check_file_info_version(name)
+
+        # Split files might not be published yet.
+        output_path = get_file_info_path(name)
+        if not is_file_info_split(name) or output_path.is_file():
+            output_path.unlink()
+            add_file_info_catalog_change(name, None)
+
+        get_file_info_changes_path(name).unlink(missing_ok=True)
+        file_info_digests.pop(name, None)
+        file_info_versions.pop(name, None)
+
+
+def compact_file_info_changes():
+    changes_dir = get_changes_dir()
+
+    count = 0
+    for changes_path in changes_dir.rglob('*.jsonl'):
+        key = changes_path.relative_to(changes_dir).as_posix().removesuffix('.jsonl')
+        data = read_file_info(key)
+        assert data is not None, key
+        write_file_info(key, data)
+        count += 1
+
+    count += publish_split_file_info()
+
+    return count
+
+
+def train_zstd_dictionary(samples: list[bytes]):
+    import zstandard
+
+    return zstandard.train_dictionary(config.by_filename_zstd_dictionary_size, samples).as_bytes()
+
+
+def get_zstd_dictionary_samples(codec: str):
+    keys = sorted(get_file_info_keys(codec))
+    random.Random(0).shuffle(keys)
+
+    max_size = config.by_filename_zstd_dictionary_samples_mb * 1024 * 1024
+
+    samples = []
+    samples_size = 0
+    for key in keys:
+        data_bytes = read_compressed_file(get_file_info_path(key, codec), codec)
+        if samples_size + len(data_bytes) > max_size:
+            continue
+
+        samples.append(data_bytes)
+        samples_size += len(data_bytes)
+
+    return samples
+
+
+def convert_file_info(from_codec: str, to_codec: str):
+    global zstd_dictionary
+
+    assert from_codec != to_codec
+
+    output_dir = get_output_dir(to_codec)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    if to_codec == 'zstd':
+        # Existing zstd files can't be read with a new dictionary.
+        assert not any(output_dir.rglob(f'*{get_codec(to_codec)["suffix"]}'))
+
+        get_zstd_dictionary_path().write_bytes(train_zstd_dictionary(get_zstd_dictionary_samples(from_codec)))
+        zstd_dictionary = None
+
+    # The entries and the digests don't depend on the codec.
+    catalog = read_file_info_catalog(from_codec)
+
+    count = 0
+    for key in get_file_info_keys(from_codec):
+        data_bytes = read_compressed_file(get_file_info_path(key, from_codec), from_codec)
+        output_path = get_file_info_path(key, to_codec)
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        write_compressed_file(output_path, data_bytes, to_codec)
+        if key in catalog:
+            catalog[key]['size'] = output_path.stat().st_size
+
+        count += 1
+
+    write_file_info_catalog(catalog, to_codec)
+    get_file_info_catalog_changes_path(to_codec).unlink(missing_ok=True)
+
+    return count
+
+
+def change_file_info_layout(layout: str):
+    assert layout != config.by_filename_layout
+
+    names = list(read_file_info_catalog())
+
+    count = 0
+    for codec in codecs:
+        output_dir = get_output_dir(codec)
+        if not output_dir.is_dir():
+            continue
+
+        for name in names:
+            path = get_file_info_path(name, codec)
+            if not path.is_file():
+                continue
+
+            new_path = get_file_info_path(name, codec, layout)
+            new_path.parent.mkdir(parents=True, exist_ok=True)
+            path.replace(new_path)
+            count += 1
+
+        if layout == 'flat':
+            for path in output_dir.iterdir():
+                if path.is_dir() and not any(path.iterdir()):
+                    path.rmdir()
+
+    return count
+
+
+def main():
+    if len(sys.argv) == 2 and sys.argv[1] == 'compact':
+        count = compact_file_info_changes()
+        print(f'Compacted changes of {count} files')
+    elif len(sys.argv) == 4 and sys.argv[1] == 'convert' and {sys.argv[2], sys.argv[3]} <= codecs.keys():
+        count = convert_file_info(sys.argv[2], sys.argv[3])
+        print(f'Converted {count} files')
+    elif len(sys.argv) == 3 and sys.argv[1] == 'layout' and sys.argv[2] in ['flat', 'fanout']:
+        count = change_file_info_layout(sys.argv[2])
+        print(f'Moved {count} files, set by_filename_layout to {sys.argv[2]!r} in config.py')
+    else:
+        print(f'Usage: {sys.argv[0]} compact')
+        print(f'       {sys.argv[0]} convert {{{",".join(codecs)}}} {{{",".join(codecs)}}}')
+        print(f'       {sys.argv[0]} layout {{flat,fanout}}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+from typing import Optional, Iterable, Any
+from multiprocessing import Pool
+import orjson
+import sys
+
+import by_filename_storage
+import config
+
+# Index of the by_filename data by update, by_update/<update_kb>.json has the
+# created date of the update and the hashes of each file name which are part
+# of the update. It's maintained by upd05, and read to find the files of
+# updates without reading all of the by_filename data.
+
+
+def get_update_index_dir():
+    return config.out_path.joinpath('by_update')
+
+
+def get_update_index_path(update_kb: str):
+    return get_update_index_dir().joinpath(f'{update_kb}.json')
+
+
+def get_update_index_complete_path():
+    # Created by the backfill, updates which were processed before upd05
+    # maintained the index are only indexed after it.
+    return get_update_index_dir().joinpath('complete')
+
+
+def read_update_index(update_kb: str) -> Optional[dict[str, Any]]:
+    path = get_update_index_path(update_kb)
+    if not path.is_file():
+        return None
+
+    return orjson.loads(path.read_bytes())
+
+
+def write_update_index(update_kb: str, index: dict[str, Any]):
+    data = orjson.dumps(index, option=orjson.OPT_SORT_KEYS)
+    by_filename_storage.write_file_atomically(get_update_index_path(update_kb), lambda fd: fd.write(data))
+
+
+def add_to_update_index(index: dict[str, Any], created: int, files: dict[str, Iterable[str]]):
+    # The same update can have a different date for each Windows version, the
+    # earliest one is kept.
+    if index.get('created') is None or created < index['created']:
+        index['created'] = created
+
+    index_files = index.setdefault('files', {})
+    for name, file_hashes in files.items():
+        index_files[name] = sorted(set(index_files.get(name, [])) | set(file_hashes))
+
+
+def add_update_indexes(pending: dict[str, dict[str, Any]]):
+    if not pending:
+        return
+
+    get_update_index_dir().mkdir(parents=True, exist_ok=True)
+
+    for update_kb, pending_index in pending.items():
+        index = read_update_index(update_kb) or {}
+        add_to_update_index(index, pending_index['created'], pending_index['files'])
+        write_update_index(update_kb, index)
+
+
+def get_update_kbs() -> list[str]:
+    return sorted(path.stem for path in get_update_index_dir().glob('*.json'))
+
+
+def get_file_hashes_of_updates(update_kbs: Iterable[str]) -> Optional[dict[str, set[str]]]:
+    file_hashes = {}
+    for update_kb in update_kbs:
+        index = read_update_index(update_kb)
+        if index is None:
+            return None
+
+        for name, hashes in index['files'].items():
+            file_hashes.setdefault(name, set()).update(hashes)
+
+    return file_hashes
+
+
+def get_file_hashes_of_updates_from_data(name: str, update_kbs: Iterable[str]):
+    update_kbs = set(update_kbs)
+
+    data = by_filename_storage.read_file_info(name)
+
+    file_hashes = set()
+
+    for file_hash in data:
+        windows_versions = data[file_hash]['windowsVersions']
+        if any(update_kbs & updates.keys() for updates in windows_versions.values()):
+            file_hashes.add(file_hash)
+
+    return file_hashes
+
+
+def is_update_index_complete():
+    return get_update_index_complete_path().is_file()
+
+
+def get_old_update_kbs(min_date: int):
+    return [update_kb for update_kb in get_update_kbs()
+            if read_update_index(update_kb)['created'] < min_date]
+
+
+def delete_update_index(update_kb: str):
+    get_update_index_path(update_kb).unlink(missing_ok=True)
+
+
+def get_update_items(name: str):
+    items = []
+
+    data = by_filename_storage.read_file_info_for_reader(name) or {}
+    for file_hash, file_hash_data in data.items():
+        for updates in file_hash_data['windowsVersions'].values():
+            for update_kb, update in updates.items():
+                if update_kb != 'BASE':
+                    items.append((update_kb, update['updateInfo']['created'], file_hash))
+
+    return name, items
+
+
+def backfill_update_indexes(processes: int = 1):
+    created_by_update = {}
+    files_by_update = {}
+
+    def add_items(items_of_names):
+        for name, items in items_of_names:
+            for update_kb, created, file_hash in items:
+                created_by_update[update_kb] = min(created_by_update.get(update_kb, created), created)
+                files_by_update.setdefault(update_kb, {}).setdefault(name, set()).add(file_hash)
+
+    names = by_filename_storage.get_file_info_names(by_filename_storage.read_file_info_catalog_for_reader())
+    if processes > 1:
+        with Pool(processes) as pool:
+            add_items(pool.imap_unordered(get_update_items, names, chunksize=16))
+    else:
+        add_items(map(get_update_items, names))
+
+    index_dir = get_update_index_dir()
+    index_dir.mkdir(parents=True, exist_ok=True)
+
+    for update_kb, files in files_by_update.items():
+        index = {}
+        add_to_update_index(index, created_by_update[update_kb], files)
+        write_update_index(update_kb, index)
+
+    # Indexes of updates which are no longer in the data.
+    for update_kb in get_update_kbs():
+        if update_kb not in files_by_update:
+            delete_update_index(update_kb)
+
+    get_update_index_complete_path().touch()
+
+    return len(files_by_update)
+
+
+def main():
+    if len(sys.argv) == 2 and sys.argv[1] == 'backfill':
+        count = backfill_update_indexes(config.index_build_processes)
+        print(f'Indexed {count} updates')
+    else:
+        print(f'Usage: {sys.argv[0]} backfill')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,6 @@
 from pathlib import Path
+import tempfile
+import os
 
 out_path_override = Path('.out_path_override')
 out_path = Path(out_path_override.read_text().strip() if out_path_override.exists() else '.')
@@ -7,6 +9,10 @@ index_of_hashes_out_path = out_path / 'hashes'
 
 deploy_save_disk_space = True
 deploy_amend_last_commit = True
+deploy_parse_manifests_in_memory = True
+# Updates processed and committed together. With more than one, each file is
+# loaded and written once for all updates of the batch.
+deploy_updates_per_batch = 1
 
 updates_unsupported = set()
 
@@ -19,9 +25,71 @@ verbose_run = False
 verbose_progress = True
 extract_in_a_new_thread = False
 exit_on_first_error = True
-high_mem_usage_for_performance = False
+# Memory for the upd05 caches of decoded by_filename data and VirusTotal info,
+# split between the worker processes. The least recently used entries are
+# spilled when the decoded sizes or the RSS of a process are over its share.
+memory_budget_mb = 1024
+file_info_cache_compact = True
+file_info_write_threads = 4
+file_info_write_in_flight_mb = 256
+# Append changes to by_filename_changes instead of rewriting whole files. The
+# changes are merged into by_filename_compressed when they grow over the max
+# size, and at the end of the deploy.
+by_filename_changes_log = False
+by_filename_changes_max_size = 1024 * 1024
+# Files with many hashes which are split into sub-shards by hash prefix, see
+# by_filename_storage.py. The count can't be changed for existing sub-shards,
+# remove by_filename_sub_shards/<name> when removing a name from the set.
+# Splitting reduces the work of each update, but publishing the full file
+# still needs its serialized size in memory, once per run.
+by_filename_sub_shard_names: set[str] = set()
+by_filename_sub_shard_count = 16
+# 'flat' for by_filename_compressed/<name>, or 'fanout' for
+# by_filename_compressed/<xx>/<name> with a prefix of the SHA256 of the name.
+# The website expects 'flat'. Change existing files with
+# "by_filename_storage.py layout".
+by_filename_layout = 'flat'
+by_filename_fanout_length = 2
+# 'none', 'file' to fsync written files, or 'file_and_dir' to also fsync the
+# directory after renaming a written file into place.
+by_filename_fsync = 'none'
+by_filename_locking = True
+by_filename_lock_count = 1024
 compression_level = 3
+# 'gzip' or 'zstd', see by_filename_storage.py.
+by_filename_codec = 'gzip'
+by_filename_zstd_level = 3
+by_filename_zstd_dictionary_size = 112640
+by_filename_zstd_dictionary_samples_mb = 100
+# Each file goes to the same upd05 worker process in all stages, which keeps
+# its data cached until the cache is over its share of memory_budget_mb.
 group_by_filename_processes = 4
+# Check the fast paths of update_file_info() against the full merge.
+update_file_info_verify = False
+group_by_filename_checkpoint_interval = 60
+# Initial estimate, learned from the processing times of previous runs.
+group_by_filename_seconds_per_cost = 1e-6
+group_iso_data_buckets = 64
+temp_path = Path(os.environ.get('WINBINDEX_TEMP', tempfile.gettempdir()))
+virustotal_info_index_path = temp_path.joinpath('winbindex_virustotal_info.sqlite')
+by_filename_lock_path = temp_path.joinpath('winbindex_by_filename_locks')
+# Index of the hashes of the by_filename data, see hash_index.py. Built with
+# "hash_index.py build" and kept up to date by upd05 and the retention.
+hash_index_path = temp_path.joinpath('winbindex_hash_index')
+hash_index_delta_max_records = 100000
+# Processes which read the by_filename data to build the indexes.
+index_build_processes = 4
+# Indexes of query.py which aren't kept up to date by the other scripts.
+query_index_path = temp_path.joinpath('winbindex_query_index')
+# 'full' validates all data. 'sampled' validates validation_sample_rate of
+# the items, selected by a hash of the item and validation_sample_seed.
+# 'verify_once' records items which passed in validation_store_path and
+# doesn't validate them again. Only the checks of VirusTotal info and of
+# manifest delta data can be skipped, cheaper checks are always done.
+validation_level = 'full'
+validation_sample_rate = 0.01
+validation_sample_seed = 0
+validation_store_path = temp_path.joinpath('winbindex_validation.sqlite')
 
 delta_machine_type_values_supported = {
     'CLI4_I386',
@@ -1,4 +1,5 @@
 from datetime import datetime, timedelta
+from functools import partial
 from pathlib import Path
 import subprocess
 import requests
@@ -13,7 +14,9 @@ from upd02_get_manifests_from_updates import main as upd02_get_manifests_from_up
 from upd03_parse_manifests import main as upd03_parse_manifests
 from upd04_get_virustotal_data import main as upd04_get_virustotal_data
 from upd05_group_by_filename import main as upd05_group_by_filename
+from upd05_group_by_filename import add_parsed_manifest_file_details, get_update_sort_key
 from symbol_server_link_enumerate import main as symbol_server_link_enumerate
+import by_filename_storage
 import config
 
 deploy_start_time = datetime.now()
@@ -52,17 +55,8 @@ def prepare_updates():
     if config.updates_never_removed:
         assert uptodate_update_kbs >= last_time_update_kbs
 
-    def kb_sort_key(update_kb):
-        for windows_version, updates in uptodate_updates.items():
-            if update_kb in updates:
-                update_info = updates[update_kb]
-                if windows_version == 'builds':
-                    return update_info['created'], update_info['build'], update_kb
-                else:
-                    return update_info['releaseDate'], update_info['releaseVersion'], update_kb
-        assert False, update_kb
-
-    new_update_kbs = sorted(uptodate_update_kbs - last_time_update_kbs, key=kb_sort_key)
+    new_update_kbs = sorted(uptodate_update_kbs - last_time_update_kbs,
+                            key=partial(get_update_sort_key, uptodate_updates))
     if len(new_update_kbs) == 0:
         temp_updates_path.unlink()
         print('No new updates')
@@ -70,21 +64,21 @@ def prepare_updates():
 
     print(f'New updates: {new_update_kbs}')
 
-    # Update one at a time.
-    update_kb = new_update_kbs[0]
+    # Update a batch at a time, each batch is a commit.
+    update_kbs = new_update_kbs[:config.deploy_updates_per_batch]
 
-    print(f'Updating {update_kb}')
+    print(f'Updating {", ".join(update_kbs)}')
 
-    single_update = filter_updates(uptodate_updates, {update_kb})
+    batch_updates = filter_updates(uptodate_updates, set(update_kbs))
 
     with open(temp_updates_path, 'w') as f:
-        json.dump(single_update, f, indent=4)
+        json.dump(batch_updates, f, indent=4)
 
     with open(last_time_updates_path, 'w') as f:
-        last_time_updates = filter_updates(uptodate_updates, last_time_update_kbs | {update_kb})
+        last_time_updates = filter_updates(uptodate_updates, last_time_update_kbs | set(update_kbs))
         json.dump(last_time_updates, f, indent=4, sort_keys=True)
 
-    return update_kb
+    return update_kbs
 
 
 def add_update_to_info_progress_symbol_server(update_kb):
@@ -240,9 +234,13 @@ def run_deploy():
             progress_state = json.load(f)
 
         progress_file.unlink()
+
+        # Saved before batches were supported.
+        if 'update_kb' in progress_state:
+            progress_state['update_kbs'] = [progress_state.pop('update_kb')]
     else:
-        new_single_update = prepare_updates()
-        if not new_single_update:
+        new_update_kbs = prepare_updates()
+        if not new_update_kbs:
             # No updates, try to fetch info instead.
             result = run_symbol_server_updates()
             if result:
@@ -251,7 +249,7 @@ def run_deploy():
                 return run_virustotal_updates()
 
         progress_state = {
-            'update_kb': new_single_update,
+            'update_kbs': new_update_kbs,
             'files_processed': [],
             'files_total': None
         }
@@ -260,31 +258,45 @@ def run_deploy():
     upd02_get_manifests_from_updates()
 
     print('Running upd03_parse_manifests')
-    upd03_parse_manifests()
+    if config.deploy_parse_manifests_in_memory:
+        # Skip the parsed/ directory, upd05 groups the parsed manifests
+        # directly. If the run is interrupted, the manifests are parsed again
+        # on the next run, and _progress.json is used to skip processed files.
+        parsed_file_details = {}
+        upd03_parse_manifests(partial(add_parsed_manifest_file_details, parsed_file_details))
+    else:
+        parsed_file_details = None
+        upd03_parse_manifests()
 
     if config.deploy_save_disk_space:
         clean_deploy_files(['manifests/'])
 
     print('Running upd05_group_by_filename')
-    upd05_group_by_filename(progress_state, time_to_stop)
+    upd05_group_by_filename(progress_state, time_to_stop, parsed_file_details, progress_file)
 
     if config.deploy_save_disk_space:
         clean_deploy_files(['parsed/'])
 
+    update_kbs_str = ', '.join(progress_state['update_kbs'])
+
     if len(progress_state['files_processed']) < progress_state['files_total']:
         with open(progress_file, 'w') as f:
             json.dump(progress_state, f, indent=4)
 
-        return f'Updated with files from {progress_state["update_kb"]} ({len(progress_state["files_processed"])} of {progress_state["files_total"]})'
+        return f'Updated with files from {update_kbs_str} ({len(progress_state["files_processed"])} of {progress_state["files_total"]})'
 
     assert len(progress_state['files_processed']) == progress_state['files_total']
 
+    # Might have been saved by upd05 as a checkpoint.
+    progress_file.unlink(missing_ok=True)
+
     config.out_path.joinpath('updates.json').unlink()
 
-    add_update_to_info_progress_symbol_server(progress_state['update_kb'])
-    add_update_to_info_progress_virustotal(progress_state['update_kb'])
+    for update_kb in progress_state['update_kbs']:
+        add_update_to_info_progress_symbol_server(update_kb)
+        add_update_to_info_progress_virustotal(update_kb)
 
-    return f'Updated with files from {progress_state["update_kb"]}'
+    return f'Updated with files from {update_kbs_str}'
 
 
 def build_html_index_of_hashes():
@@ -469,6 +481,9 @@ def commit_deploy(pr_title):
 
     git_cmd = ['git', '-C', config.out_path]
 
+    # Temp files of interrupted writes, see write_file_atomically().
+    clean_deploy_files(['*.tmp'])
+
     subprocess.check_call(git_cmd + ['add', '-A'])
 
     # https://stackoverflow.com/a/2659808
@@ -511,6 +526,15 @@ def clean_deploy_files(pathspecs=[]):
     subprocess.check_call(cmd)
 
 
+def compact_by_filename_changes():
+    if not config.by_filename_changes_log:
+        return
+
+    num_files = by_filename_storage.compact_file_info_changes()
+    if num_files > 0:
+        commit_deploy(f'Compacted changes of {num_files} files')
+
+
 def main():
     # Unsupported in this flow.
     assert not config.extract_in_a_new_thread
@@ -518,6 +542,7 @@ def main():
     while True:
         pr_title = run_deploy()
         if not pr_title:
+            compact_by_filename_changes()
             print('run_deploy() returned None, exiting')
             return
 
@@ -531,6 +556,7 @@ def main():
         # as long as there are other tasks.
         match = re.match(r'Updated info of (\d+) files from VirusTotal$', pr_title)
         if match and not is_handling_update_in_info_progress_virustotal():
+            compact_by_filename_changes()
             print('Done')
             return
 
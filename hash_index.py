@@ -0,0 +1,475 @@
+from typing import Optional, Iterable, Any
+from multiprocessing import Pool
+import bisect
+import heapq
+import mmap
+import sys
+
+import by_filename_storage
+import config
+
+# Tables of fixed width records in hash_index_path, each a key and a value.
+# The sha256, sha1 and md5 tables map the hashes of files to file name ids,
+# which are line numbers in names.txt, and the sha1_sha256 table maps SHA1
+# hashes to SHA256 hashes. A table has a base file of sorted records, which is
+# memory mapped for binary search lookups, and a delta file of added and
+# removed records, which is merged into the base file when it grows over
+# hash_index_delta_max_records.
+TABLES = {
+    'sha256': (32, 4),
+    'sha1': (20, 4),
+    'md5': (16, 4),
+    'sha1_sha256': (20, 32),
+}
+
+DELTA_ADD = b'+'
+DELTA_REMOVE = b'-'
+
+hash_index_names: Optional[list[str]] = None
+hash_index_name_ids: dict[str, int] = {}
+hash_index_tables: dict[str, dict[str, Any]] = {}
+
+
+class TableKeys:
+    # The keys of the records of a base file, as a sequence for bisect.
+    def __init__(self, data, key_size: int, record_size: int):
+        self.data = data
+        self.key_size = key_size
+        self.record_size = record_size
+
+    def __len__(self):
+        return len(self.data) // self.record_size
+
+    def __getitem__(self, index: int):
+        offset = index * self.record_size
+        return self.data[offset:offset + self.key_size]
+
+
+def get_hash_index_names_path():
+    return config.hash_index_path.joinpath('names.txt')
+
+
+def get_hash_index_complete_path():
+    return config.hash_index_path.joinpath('complete')
+
+
+def get_hash_index_data_version_path():
+    # The version of the by_filename data which the index is of, see
+    # by_filename_storage.get_file_info_catalog_version().
+    return config.hash_index_path.joinpath('data_version')
+
+
+def get_table_path(table: str):
+    return config.hash_index_path.joinpath(f'{table}.bin')
+
+
+def get_table_delta_path(table: str):
+    return config.hash_index_path.joinpath(f'{table}_delta.bin')
+
+
+def is_hash_index_built():
+    return get_hash_index_complete_path().is_file()
+
+
+def is_hash_index_up_to_date():
+    # The index is in the temp dir, the data might have been changed without
+    # updating it, e.g. by pulling newer data.
+    version_path = get_hash_index_data_version_path()
+    if not is_hash_index_built() or not version_path.is_file():
+        return False
+
+    catalog = by_filename_storage.read_file_info_catalog_for_reader()
+    return version_path.read_text() == by_filename_storage.get_file_info_catalog_version(catalog)
+
+
+def set_hash_index_data_version(version: Optional[str] = None):
+    if version is None:
+        catalog = by_filename_storage.read_file_info_catalog_for_reader()
+        version = by_filename_storage.get_file_info_catalog_version(catalog)
+
+    version_bytes = version.encode()
+    by_filename_storage.write_file_atomically(get_hash_index_data_version_path(), lambda fd: fd.write(version_bytes))
+
+
+def get_hash_table(file_hash: str):
+    tables = {64: 'sha256', 40: 'sha1', 32: 'md5'}
+    assert len(file_hash) in tables, file_hash
+    return tables[len(file_hash)]
+
+
+def get_file_info_hashes(file_info: Optional[dict[str, Any]]):
+    if not file_info:
+        return None, None
+
+    return file_info.get('sha1'), file_info.get('md5')
+
+
+def load_names():
+    global hash_index_names
+
+    if hash_index_names is None:
+        names_path = get_hash_index_names_path()
+        hash_index_names = names_path.read_text(encoding='utf-8').splitlines() if names_path.is_file() else []
+        hash_index_name_ids.clear()
+        hash_index_name_ids.update((name, name_id) for name_id, name in enumerate(hash_index_names))
+
+    return hash_index_names
+
+
+def apply_delta_record(state: dict[str, Any], op: bytes, record: bytes):
+    key_size = state['key_size']
+    key, value = record[:key_size], record[key_size:]
+
+    if op == DELTA_ADD:
+        state['adds'].setdefault(key, set()).add(value)
+        state['removes'].discard(record)
+    else:
+        assert op == DELTA_REMOVE, op
+        state['adds'].get(key, set()).discard(value)
+        state['removes'].add(record)
+
+    state['delta_count'] += 1
+
+
+def open_table(table: str):
+    if table in hash_index_tables:
+        return hash_index_tables[table]
+
+    key_size, value_size = TABLES[table]
+    record_size = key_size + value_size
+
+    data = b''
+    path = get_table_path(table)
+    if path.is_file() and path.stat().st_size > 0:
+        with open(path, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    assert len(data) % record_size == 0, table
+
+    state = {
+        'key_size': key_size,
+        'record_size': record_size,
+        'data': data,
+        'keys': TableKeys(data, key_size, record_size),
+        'adds': {},
+        'removes': set(),
+        'delta_count': 0,
+    }
+
+    delta_path = get_table_delta_path(table)
+    if delta_path.is_file():
+        delta = delta_path.read_bytes()
+        delta_record_size = 1 + record_size
+
+        # A partial record of an interrupted append is ignored.
+        for offset in range(0, len(delta) - delta_record_size + 1, delta_record_size):
+            apply_delta_record(state, delta[offset:offset + 1], delta[offset + 1:offset + delta_record_size])
+
+    hash_index_tables[table] = state
+    return state
+
+
+def close_hash_index():
+    global hash_index_names
+
+    for state in hash_index_tables.values():
+        if isinstance(state['data'], mmap.mmap):
+            state['data'].close()
+
+    hash_index_tables.clear()
+    hash_index_names = None
+    hash_index_name_ids.clear()
+
+
+def lookup_table_from(state: dict[str, Any], key: bytes, index: int):
+    data = state['data']
+    keys = state['keys']
+    record_size = state['record_size']
+
+    values = set()
+
+    index = bisect.bisect_left(keys, key, index)
+    while index < len(keys) and keys[index] == key:
+        offset = index * record_size
+        record = data[offset:offset + record_size]
+        if record not in state['removes']:
+            values.add(record[state['key_size']:])
+        index += 1
+
+    values |= state['adds'].get(key, set())
+
+    return values, index
+
+
+def lookup_table(table: str, key: bytes):
+    values, _ = lookup_table_from(open_table(table), key, 0)
+    return values
+
+
+def lookup_table_many(table: str, keys: Iterable[bytes]):
+    state = open_table(table)
+
+    # Sorted, so that each search starts where the previous one ended.
+    result = {}
+    index = 0
+    for key in sorted(set(keys)):
+        values, index = lookup_table_from(state, key, index)
+        if values:
+            result[key] = values
+
+    return result
+
+
+def get_names_of_hashes(file_hashes: Iterable[str]) -> Optional[dict[str, list[str]]]:
+    # Hashes which aren't in the index are left out of the result.
+    if not is_hash_index_built():
+        return None
+
+    names = load_names()
+
+    keys_by_table = {}
+    for file_hash in file_hashes:
+        keys_by_table.setdefault(get_hash_table(file_hash), []).append(bytes.fromhex(file_hash))
+
+    result = {}
+    for table, keys in keys_by_table.items():
+        for key, values in lookup_table_many(table, keys).items():
+            result[key.hex()] = sorted(names[int.from_bytes(value, 'big')] for value in values)
+
+    return result
+
+
+def get_names_of_hash(file_hash: str) -> Optional[list[str]]:
+    result = get_names_of_hashes([file_hash])
+    if result is None:
+        return None
+
+    return result.get(file_hash.lower(), [])
+
+
+def get_sha256_of_sha1(sha1: str) -> Optional[str]:
+    if not is_hash_index_built():
+        return None
+
+    values = lookup_table('sha1_sha256', bytes.fromhex(sha1))
+    if not values:
+        return None
+
+    return min(values).hex()
+
+
+def get_file_hash_records(name_id: int, sha256: str, sha1: Optional[str], md5: Optional[str]):
+    value = name_id.to_bytes(4, 'big')
+
+    records = [('sha256', bytes.fromhex(sha256) + value)]
+    if sha1:
+        records.append(('sha1', bytes.fromhex(sha1) + value))
+    if md5:
+        records.append(('md5', bytes.fromhex(md5) + value))
+
+    for table, record in records:
+        assert len(record) == sum(TABLES[table]), (table, record)
+
+    return records
+
+
+def has_record(table: str, record: bytes):
+    key_size, _ = TABLES[table]
+    return record[key_size:] in lookup_table(table, record[:key_size])
+
+
+def append_table_delta(table: str, delta: list[tuple[bytes, bytes]]):
+    key_size, value_size = TABLES[table]
+    delta_record_size = 1 + key_size + value_size
+
+    with open(get_table_delta_path(table), 'ab') as f:
+        # Drop a partial record of an interrupted append.
+        size = f.tell()
+        if size % delta_record_size != 0:
+            f.truncate(size - size % delta_record_size)
+            f.seek(0, 2)
+
+        f.write(b''.join(op + record for op, record in delta))
+
+
+def update_hash_index(
+    added: Iterable[tuple[str, str, Optional[str], Optional[str]]],
+    removed: Iterable[tuple[str, str, Optional[str], Optional[str]]] = (),
+):
+    # Items are (name, sha256, sha1, md5). Without a full build, the index
+    # would miss the hashes of the other files.
+    if not is_hash_index_built():
+        return
+
+    names = load_names()
+    new_names = []
+    delta = {table: [] for table in TABLES}
+
+    def add_delta_record(table, op, record):
+        if has_record(table, record) == (op == DELTA_ADD):
+            return
+
+        apply_delta_record(open_table(table), op, record)
+        delta[table].append((op, record))
+
+    for name, sha256, sha1, md5 in added:
+        name_id = hash_index_name_ids.get(name)
+        if name_id is None:
+            name_id = len(names)
+            names.append(name)
+            hash_index_name_ids[name] = name_id
+            new_names.append(name)
+
+        for table, record in get_file_hash_records(name_id, sha256, sha1, md5):
+            add_delta_record(table, DELTA_ADD, record)
+
+        if sha1:
+            add_delta_record('sha1_sha256', DELTA_ADD, bytes.fromhex(sha1) + bytes.fromhex(sha256))
+
+    bridge_removed = set()
+    for name, sha256, sha1, md5 in removed:
+        name_id = hash_index_name_ids.get(name)
+        if name_id is None:
+            continue
+
+        for table, record in get_file_hash_records(name_id, sha256, sha1, md5):
+            add_delta_record(table, DELTA_REMOVE, record)
+
+        if sha1:
+            bridge_removed.add((sha1, sha256))
+
+    # The SHA1 to SHA256 mapping is kept while other files have the hash.
+    for sha1, sha256 in sorted(bridge_removed):
+        if not lookup_table('sha256', bytes.fromhex(sha256)):
+            add_delta_record('sha1_sha256', DELTA_REMOVE, bytes.fromhex(sha1) + bytes.fromhex(sha256))
+
+    # Names are written first, records refer to them.
+    if new_names:
+        with open(get_hash_index_names_path(), 'a', encoding='utf-8') as f:
+            f.write(''.join(name + '\n' for name in new_names))
+
+    for table, table_delta in delta.items():
+        if table_delta:
+            append_table_delta(table, table_delta)
+
+    for table in TABLES:
+        if open_table(table)['delta_count'] > config.hash_index_delta_max_records:
+            compact_table(table)
+
+
+def write_table(table: str, records: Iterable[bytes]):
+    def write(fd):
+        last_record = None
+        for record in records:
+            if record != last_record:
+                fd.write(record)
+            last_record = record
+
+    by_filename_storage.write_file_atomically(get_table_path(table), write)
+
+
+def compact_table(table: str):
+    state = open_table(table)
+    data = state['data']
+    record_size = state['record_size']
+
+    def base_records():
+        for offset in range(0, len(data), record_size):
+            record = data[offset:offset + record_size]
+            if record not in state['removes']:
+                yield record
+
+    added = sorted(key + value for key, values in state['adds'].items() for value in values)
+
+    # The base file is written while it's mapped, the new file replaces it
+    # only after it's closed.
+    temp_table = f'{table}_compacted'
+    write_table(temp_table, heapq.merge(base_records(), added))
+
+    close_hash_index()
+    get_table_path(temp_table).replace(get_table_path(table))
+
+    # If interrupted before the delta is removed, it's applied again, which
+    # doesn't change anything.
+    get_table_delta_path(table).unlink(missing_ok=True)
+
+
+def get_file_hash_items(name: str):
+    data = by_filename_storage.read_file_info_for_reader(name) or {}
+    return [(file_hash, *get_file_info_hashes(file_hash_data.get('fileInfo')))
+            for file_hash, file_hash_data in data.items()]
+
+
+def build_hash_index(processes: int = 1):
+    close_hash_index()
+
+    catalog = by_filename_storage.read_file_info_catalog_for_reader()
+    names = by_filename_storage.get_file_info_names(catalog)
+
+    records = {table: [] for table in TABLES}
+
+    def add_records(items_of_names):
+        for name_id, items in enumerate(items_of_names):
+            for file_hash, sha1, md5 in items:
+                for table, record in get_file_hash_records(name_id, file_hash, sha1, md5):
+                    records[table].append(record)
+
+                if sha1:
+                    records['sha1_sha256'].append(bytes.fromhex(sha1) + bytes.fromhex(file_hash))
+
+    # Files are read in parallel, in order, since the name ids are their
+    # positions.
+    if processes > 1:
+        with Pool(processes) as pool:
+            add_records(pool.imap(get_file_hash_items, names, chunksize=16))
+    else:
+        add_records(map(get_file_hash_items, names))
+
+    config.hash_index_path.mkdir(parents=True, exist_ok=True)
+    get_hash_index_complete_path().unlink(missing_ok=True)
+    get_hash_index_data_version_path().unlink(missing_ok=True)
+
+    names_bytes = ''.join(name + '\n' for name in names).encode('utf-8')
+    by_filename_storage.write_file_atomically(get_hash_index_names_path(), lambda fd: fd.write(names_bytes))
+
+    for table in TABLES:
+        write_table(table, sorted(records[table]))
+        get_table_delta_path(table).unlink(missing_ok=True)
+
+    get_hash_index_complete_path().touch()
+    set_hash_index_data_version(by_filename_storage.get_file_info_catalog_version(catalog))
+
+    return {table: len(table_records) for table, table_records in records.items()}
+
+
+def main():
+    if len(sys.argv) == 2 and sys.argv[1] == 'build':
+        counts = build_hash_index(config.index_build_processes)
+        print(', '.join(f'{table}: {count} records' for table, count in counts.items()))
+    elif len(sys.argv) == 2 and sys.argv[1] == 'compact':
+        for table in TABLES:
+            compact_table(table)
+    elif len(sys.argv) == 3 and sys.argv[1] == 'lookup':
+        file_hash = sys.argv[2].lower()
+        names = get_names_of_hash(file_hash)
+        if names is None:
+            print('The hash index is not built')
+            sys.exit(1)
+
+        if not is_hash_index_up_to_date():
+            print('WARNING: The data changed since the hash index was built, run "hash_index.py build"')
+
+        if get_hash_table(file_hash) == 'sha1':
+            print(f'SHA256: {get_sha256_of_sha1(file_hash)}')
+
+        for name in names:
+            print(name)
+    else:
+        print(f'Usage: {sys.argv[0]} build')
+        print(f'       {sys.argv[0]} compact')
+        print(f'       {sys.argv[0]} lookup <hash>')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
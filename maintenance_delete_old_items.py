@@ -1,26 +1,18 @@
 import datetime
 import json
-from pathlib import Path
 import sys
 
-import orjson
-from isal import igzip as gzip
-
+import by_filename_storage
+import by_update_index
+import hash_index
 import config
 
 
-def write_to_gzip_file(file, data):
-    with open(file, 'wb') as fd:
-        with gzip.GzipFile(fileobj=fd, mode='w', compresslevel=config.compression_level, filename='', mtime=0) as gz:
-            gz.write(data)
-
-
-def delete_old_data_for_file(name: str, path: Path, min_date: int):
-    with gzip.open(path, 'rb') as f:
-        data = orjson.loads(f.read())
+def delete_old_data_for_file(name: str, min_date: int):
+    data = by_filename_storage.read_file_info(name)
 
     some_deleted = False
-    deleted_file_hashes = set()
+    deleted_file_hashes = {}
 
     data_new = {}
 
@@ -40,27 +32,27 @@ def delete_old_data_for_file(name: str, path: Path, min_date: int):
             data_new[file_hash] = data[file_hash]
             data_new[file_hash]['windowsVersions'] = windows_versions_new
         else:
-            deleted_file_hashes.add((name, file_hash))
+            deleted_file_hashes[(name, file_hash)] = hash_index.get_file_info_hashes(data[file_hash].get('fileInfo'))
 
     if some_deleted:
         if data_new == {}:
-            path.unlink()
+            by_filename_storage.delete_file_info(name)
         else:
-            write_to_gzip_file(path, orjson.dumps(data_new))
+            by_filename_storage.write_file_info(name, data_new)
     else:
         assert data_new == data
 
     return deleted_file_hashes
 
 
-def update_filenames_json(output_dir: Path):
-    all_filenames = sorted(path.with_suffix('').stem for path in output_dir.glob('*.json.gz'))
+def update_filenames_json():
+    all_filenames = sorted(by_filename_storage.get_file_info_names())
 
     with open(config.out_path.joinpath('filenames.json'), 'w') as f:
         json.dump(all_filenames, f, indent=0, sort_keys=True)
 
 
-def update_info_sources_json(deleted_file_hashes: set):
+def update_info_sources_json(deleted_file_hashes: dict):
     info_sources_path = config.out_path.joinpath('info_sources.json')
     with open(info_sources_path, 'r') as f:
         info_sources = json.load(f)
@@ -83,17 +75,44 @@ def update_info_sources_json(deleted_file_hashes: set):
 
 
 def delete_old_data(min_date: int):
-    output_dir = config.out_path.joinpath('by_filename_compressed')
-
     print('Deleting old items')
-    deleted_file_hashes = set()
-    for path in output_dir.glob('*.json.gz'):
-        name = path.name.removesuffix('.json.gz')
+
+    old_update_kbs = by_update_index.get_old_update_kbs(min_date)
+
+    hash_index_up_to_date = hash_index.is_hash_index_up_to_date()
+
+    names = by_filename_storage.get_file_info_names()
+    if by_update_index.is_update_index_complete():
+        # Only files of the old updates have old items.
+        old_update_names = set()
+        for update_kb in old_update_kbs:
+            old_update_names.update(by_update_index.read_update_index(update_kb)['files'])
+
+        names = [name for name in names if name in old_update_names]
+
+    deleted_file_hashes = {}
+    for name in names:
         print(f'Deleting old items in {name}')
-        deleted_file_hashes |= delete_old_data_for_file(name, path, min_date)
+        deleted_file_hashes |= delete_old_data_for_file(name, min_date)
+
+    print('Updating the update index')
+    for update_kb in old_update_kbs:
+        by_update_index.delete_update_index(update_kb)
+
+    print('Updating the hash index')
+    hash_index.update_hash_index([], [(name, file_hash, sha1, md5)
+                                      for (name, file_hash), (sha1, md5) in deleted_file_hashes.items()])
+
+    # Split files were only written to their sub-shards.
+    print('Publishing split files')
+    by_filename_storage.publish_split_file_info()
+    by_filename_storage.compact_file_info_catalog()
+
+    if hash_index_up_to_date:
+        hash_index.set_hash_index_data_version()
 
     print('Updating filenames.json')
-    update_filenames_json(output_dir)
+    update_filenames_json()
 
     print('Updating info_sources.json')
     update_info_sources_json(deleted_file_hashes)
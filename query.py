@@ -0,0 +1,164 @@
+from typing import Optional, Any
+import orjson
+import sys
+
+import by_filename_storage
+import by_update_index
+import hash_index
+import config
+
+# Queries over the by_filename data which use the indexes to read only the
+# files they need: the hash index, the update index, and an index of
+# info_sources.json by info source which is kept here. Results are printed as
+# JSON.
+
+
+def get_info_source_index_dir():
+    return config.query_index_path.joinpath('info_sources')
+
+
+def get_info_source_index_path(info_source: str):
+    return get_info_source_index_dir().joinpath(f'{info_source}.json')
+
+
+def get_info_source_index_version_path():
+    return config.query_index_path.joinpath('info_sources_version.json')
+
+
+def get_info_sources_version():
+    stat = config.out_path.joinpath('info_sources.json').stat()
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def update_info_source_index():
+    # Rebuilt only if info_sources.json changed, and only the sources which
+    # changed are written.
+    version = get_info_sources_version()
+    version_path = get_info_source_index_version_path()
+    if version_path.is_file() and orjson.loads(version_path.read_bytes()) == version:
+        return False
+
+    info_sources = orjson.loads(config.out_path.joinpath('info_sources.json').read_bytes())
+
+    items_by_source = {}
+    for name, file_hashes in info_sources.items():
+        for file_hash, info_source in file_hashes.items():
+            items_by_source.setdefault(info_source, []).append([name, file_hash])
+
+    index_dir = get_info_source_index_dir()
+    index_dir.mkdir(parents=True, exist_ok=True)
+
+    for info_source, items in items_by_source.items():
+        items_bytes = orjson.dumps(sorted(items))
+        path = get_info_source_index_path(info_source)
+        if not path.is_file() or path.read_bytes() != items_bytes:
+            by_filename_storage.write_file_atomically(path, lambda fd: fd.write(items_bytes))
+
+    for path in index_dir.glob('*.json'):
+        if path.stem not in items_by_source:
+            path.unlink()
+
+    version_bytes = orjson.dumps(version)
+    by_filename_storage.write_file_atomically(version_path, lambda fd: fd.write(version_bytes))
+
+    return True
+
+
+def query_hashes_of_file(name: str, build: Optional[str] = None):
+    # The build can be a build number, an update KB or a Windows version.
+    data = by_filename_storage.read_file_info_for_reader(name) or {}
+
+    file_hashes = []
+    for file_hash, file_hash_data in data.items():
+        for windows_version, updates in file_hash_data['windowsVersions'].items():
+            if build is None or build == windows_version or any(
+                build == update_kb or build == update.get('updateInfo', {}).get('build')
+                for update_kb, update in updates.items()
+            ):
+                file_hashes.append(file_hash)
+                break
+
+    return sorted(file_hashes)
+
+
+def query_updates_of_hash(file_hash: str):
+    file_hash = file_hash.lower()
+
+    names = hash_index.get_names_of_hash(file_hash)
+    if names is None:
+        raise Exception('The hash index is not built, run "query.py index"')
+
+    if not hash_index.is_hash_index_up_to_date():
+        print('WARNING: The data changed since the hash index was built, run "query.py index"', file=sys.stderr)
+
+    table = hash_index.get_hash_table(file_hash)
+    if table == 'sha256':
+        sha256 = file_hash
+    elif table == 'sha1':
+        sha256 = hash_index.get_sha256_of_sha1(file_hash)
+    else:
+        sha256 = None
+
+    result = {}
+    for name in names:
+        # The data is keyed by the SHA256 hash, if it's known only its
+        # sub-shard is read.
+        key = by_filename_storage.get_file_info_read_key(name, sha256) if sha256 else name
+        data = by_filename_storage.read_file_info_for_reader(key) or {}
+        for data_hash, file_hash_data in data.items():
+            file_info = file_hash_data.get('fileInfo') or {}
+            if file_hash not in [data_hash, file_info.get('sha1'), file_info.get('md5')]:
+                continue
+
+            for windows_version, updates in file_hash_data['windowsVersions'].items():
+                result.setdefault(name, {}).setdefault(windows_version, []).extend(sorted(updates))
+
+    return result
+
+
+def query_files_by_info_source(info_source: str):
+    update_info_source_index()
+
+    path = get_info_source_index_path(info_source)
+    if not path.is_file():
+        return []
+
+    return orjson.loads(path.read_bytes())
+
+
+def build_indexes():
+    if not hash_index.is_hash_index_up_to_date():
+        counts = hash_index.build_hash_index(config.index_build_processes)
+        print(f'Hash index: {", ".join(f"{table}: {count} records" for table, count in counts.items())}')
+
+    if not by_update_index.is_update_index_complete():
+        count = by_update_index.backfill_update_indexes(config.index_build_processes)
+        print(f'Update index: {count} updates')
+
+    if update_info_source_index():
+        print('Info source index: updated')
+
+
+def print_result(result: Any):
+    sys.stdout.buffer.write(orjson.dumps(result, option=orjson.OPT_INDENT_2) + b'\n')
+
+
+def main():
+    if len(sys.argv) == 2 and sys.argv[1] == 'index':
+        build_indexes()
+    elif len(sys.argv) in [3, 4] and sys.argv[1] == 'hashes':
+        print_result(query_hashes_of_file(*sys.argv[2:]))
+    elif len(sys.argv) == 3 and sys.argv[1] == 'updates':
+        print_result(query_updates_of_hash(sys.argv[2]))
+    elif len(sys.argv) == 3 and sys.argv[1] == 'source':
+        print_result(query_files_by_info_source(sys.argv[2]))
+    else:
+        print(f'Usage: {sys.argv[0]} index')
+        print(f'       {sys.argv[0]} hashes <filename> [build, update KB or Windows version]')
+        print(f'       {sys.argv[0]} updates <hash>')
+        print(f'       {sys.argv[0]} source <info source>')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,42 +1,15 @@
-from isal import igzip as gzip
 from datetime import datetime
 import concurrent.futures
 from pathlib import Path
 import requests
-import orjson
 import json
 import time
 
+import by_filename_storage
+import by_update_index
 import config
 
 
-def write_to_gzip_file(file, data):
-    with open(file, 'wb') as fd:
-        with gzip.GzipFile(fileobj=fd, mode='w', compresslevel=config.compression_level, filename='', mtime=0) as gz:
-            gz.write(data)
-
-
-def get_file_hashes_of_updates(name, updates):
-    output_dir = config.out_path.joinpath('by_filename_compressed')
-
-    with gzip.open(output_dir.joinpath(f'{name}.json.gz'), 'r') as f:
-        data = orjson.loads(f.read())
-
-    file_hashes = set()
-
-    for file_hash in data:
-        file_updates = set()
-
-        windows_versions = data[file_hash]['windowsVersions']
-        for windows_version in windows_versions:
-            file_updates |= windows_versions[windows_version].keys()
-
-        if any(update in updates for update in file_updates):
-            file_hashes.add(file_hash)
-
-    return file_hashes
-
-
 def make_symbol_server_url(file_name, timestamp, size):
     return f'https://msdl.microsoft.com/download/symbols/{file_name}/{timestamp:08X}{size:x}/{file_name}'
 
@@ -129,10 +102,9 @@ def get_symbol_server_links_for_files(names_and_hashes, session, time_to_stop):
         'next': None,
     }
 
-    output_dir = config.out_path.joinpath('by_filename_compressed')
-    output_path = None
+    data_name = None
     data = None
-    data_modified = False
+    data_changed_paths = []
 
     count = 0
     for name, hash in names_and_hashes:
@@ -140,20 +112,18 @@ def get_symbol_server_links_for_files(names_and_hashes, session, time_to_stop):
             result['next'] = (name, hash)
             break
 
-        new_output_path = output_dir.joinpath(f'{name}.json.gz')
-        if new_output_path != output_path:
-            if output_path and data_modified:
-                write_to_gzip_file(output_path, orjson.dumps(data))
+        if name != data_name:
+            if data_name and data_changed_paths:
+                by_filename_storage.write_file_info_changes(data_name, data, data_changed_paths)
 
-            output_path = output_dir.joinpath(f'{name}.json.gz')
-            with gzip.open(output_path, 'rb') as f:
-                data = orjson.loads(f.read())
-                data_modified = False
+            data_name = name
+            data = by_filename_storage.read_file_info(name)
+            data_changed_paths = []
 
         new_data = get_symbol_server_links_for_file(session, hash, name, data)
         if new_data:
             data = new_data
-            data_modified = True
+            data_changed_paths.append((hash, 'fileInfo'))
             result['found'].add((name, hash))
         else:
             result['not_found'].add((name, hash))
@@ -162,8 +132,8 @@ def get_symbol_server_links_for_files(names_and_hashes, session, time_to_stop):
         if count % 10 == 0 and config.verbose_progress:
             print(f'Processed {count} of {len(names_and_hashes)}')
 
-    if output_path and data_modified:
-        write_to_gzip_file(output_path, orjson.dumps(data))
+    if data_name and data_changed_paths:
+        by_filename_storage.write_file_info_changes(data_name, data, data_changed_paths)
 
     return result
 
@@ -191,6 +161,12 @@ def main(time_to_stop=None):
     if progress_updates == []:
         return None  # no updates to process
 
+    # The files of the updates are taken from the update index, or from the
+    # data of each file if an update isn't indexed.
+    update_file_hashes = None
+    if progress_updates is not None:
+        update_file_hashes = by_update_index.get_file_hashes_of_updates(progress_updates)
+
     # Get names and hashes of all PE files with multiple links.
     names_and_hashes = []
     for name in info_sources.keys():
@@ -198,8 +174,10 @@ def main(time_to_stop=None):
         if not file_hashes:
             continue
 
-        if progress_updates is not None:
-            file_hashes &= get_file_hashes_of_updates(name, progress_updates)
+        if update_file_hashes is not None:
+            file_hashes &= update_file_hashes.get(name, set())
+        elif progress_updates is not None:
+            file_hashes &= by_update_index.get_file_hashes_of_updates_from_data(name, progress_updates)
 
         names_and_hashes += [(name, hash) for hash in file_hashes]
 
@@ -217,6 +195,8 @@ def main(time_to_stop=None):
 
     result = get_symbol_server_links_for_files(names_and_hashes, session, time_to_stop)
 
+    by_filename_storage.compact_file_info_catalog()
+
     if result['next'] is None:
         # All items were processed.
         info_progress_symbol_server['next'] = None
@@ -1,8 +1,8 @@
 from signify.authenticode.signed_file import SignedPEFile
 import xml.etree.ElementTree as ET
 from struct import unpack
+from typing import List, Optional, Callable
 from pathlib import Path
-from typing import List
 import fnmatch
 import hashlib
 import signify
@@ -12,6 +12,7 @@ import json
 import re
 
 import config
+import validation
 
 file_hashes = {}
 
@@ -211,6 +212,15 @@ def get_file_signing_times(pathname: Path):
     return signing_times
 
 
+def get_delta_data_exceptions():
+    # Validated delta data is validated again if these change.
+    return [
+        sorted(config.delta_data_without_rift_table_names),
+        sorted(config.delta_data_without_rift_table_manifests),
+        sorted(config.delta_data_without_rift_table_hashes),
+    ]
+
+
 def get_delta_data_for_manifest_file(manifest_path: Path, name: str, algorithm_to_assert: str, hash_to_assert: str):
     delta_path = manifest_path.parent.joinpath(manifest_path.stem, 'f', name + '.dd.txt')
     if not delta_path.exists():
@@ -223,11 +233,16 @@ def get_delta_data_for_manifest_file(manifest_path: Path, name: str, algorithm_t
     for key, value in key_value:
         delta_data[key] = value.strip()
 
+    # The exceptions for delta data without RiftTable depend on the names.
+    validation_key = validation.get_content_key(delta_data_raw, algorithm_to_assert, hash_to_assert,
+                                                name, manifest_path.name, get_delta_data_exceptions())
+    validate = validation.should_validate('manifest_delta_data', validation_key)
+
     if delta_data['HashAlgorithm'] == 'CALG_MD5':
-        if algorithm_to_assert == 'md5':
+        if algorithm_to_assert == 'md5' and validate:
             assert delta_data['Hash'].lower() == hash_to_assert
     elif delta_data['HashAlgorithm'] == 'CALG_SHA_256':
-        if algorithm_to_assert == 'sha256':
+        if algorithm_to_assert == 'sha256' and validate:
             assert delta_data['Hash'].lower() == hash_to_assert
     else:
         assert False, delta_data['HashAlgorithm']
@@ -235,12 +250,15 @@ def get_delta_data_for_manifest_file(manifest_path: Path, name: str, algorithm_t
     # Skip delta files without RiftTable. In this case, it was also observed
     # that machineType doesn't have the correct value.
     if delta_data['Code'] != 'Raw' and delta_data['RiftTable'] == '(none)':
-        assert (
-            any(fnmatch.fnmatch(name.lower(), p) for p in config.delta_data_without_rift_table_names) or
-            any(fnmatch.fnmatch(manifest_path.name.lower(), p) for p in config.delta_data_without_rift_table_manifests) or
-            delta_data['Hash'].lower() in config.delta_data_without_rift_table_hashes
-        ), (name, manifest_path, delta_data)
-        assert int(delta_data['TimeStamp']) == 0
+        if validate:
+            assert (
+                any(fnmatch.fnmatch(name.lower(), p) for p in config.delta_data_without_rift_table_names) or
+                any(fnmatch.fnmatch(manifest_path.name.lower(), p) for p in config.delta_data_without_rift_table_manifests) or
+                delta_data['Hash'].lower() in config.delta_data_without_rift_table_hashes
+            ), (name, manifest_path, delta_data)
+            assert int(delta_data['TimeStamp']) == 0
+            validation.set_validated('manifest_delta_data', validation_key)
+
         return None
 
     result = {}
@@ -272,6 +290,9 @@ def get_delta_data_for_manifest_file(manifest_path: Path, name: str, algorithm_t
         result['lastSectionVirtualAddress'] = int(rift_table_last[0])
         result['lastSectionPointerToRawData'] = int(rift_table_last[1])
 
+    if validate:
+        validation.set_validated('manifest_delta_data', validation_key)
+
     return result
 
 
@@ -466,8 +487,13 @@ def parse_manifest(manifest_path: Path):
     return result
 
 
-def parse_manifests(manifests_dir: Path, output_dir: Path):
-    output_dir.mkdir(parents=True, exist_ok=True)
+def parse_manifests(
+    manifests_dir: Path,
+    output_dir: Path,
+    parsed_manifest_handler: Optional[Callable[[str, dict], None]] = None,
+):
+    if not parsed_manifest_handler:
+        output_dir.mkdir(parents=True, exist_ok=True)
 
     for path in manifests_dir.glob('*.manifest'):
         if not path.is_file():
@@ -489,12 +515,17 @@ def parse_manifests(manifests_dir: Path, output_dir: Path):
         if not parsed or len(parsed['files']) == 0:
             continue
 
+        # Hand the result over directly instead of writing it to disk.
+        if parsed_manifest_handler:
+            parsed_manifest_handler(path.stem, parsed)
+            continue
+
         output_filename = output_dir.joinpath(path.name).with_suffix('.json')
         with open(output_filename, 'w') as f:
             json.dump(parsed, f, indent=4)
 
 
-def main():
+def main(parsed_manifest_handler: Optional[Callable[[str, str, str, dict], None]] = None):
     with open(config.out_path.joinpath('updates.json')) as f:
         updates = json.load(f)
 
@@ -505,11 +536,19 @@ def main():
             manifests_dir = config.out_path.joinpath('manifests', windows_version, update_kb)
             if manifests_dir.is_dir():
                 output_dir = config.out_path.joinpath('parsed', windows_version, update_kb)
-                parse_manifests(manifests_dir, output_dir)
+                if parsed_manifest_handler:
+                    def update_parsed_manifest_handler(manifest_name, parsed):
+                        parsed_manifest_handler(windows_version, update_kb, manifest_name, parsed)
+
+                    parse_manifests(manifests_dir, output_dir, update_parsed_manifest_handler)
+                else:
+                    parse_manifests(manifests_dir, output_dir)
                 print('  ' + update_kb)
 
     update_file_hashes()
 
+    validation.flush_validated()
+
 
 if __name__ == '__main__':
     main()
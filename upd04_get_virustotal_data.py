@@ -1,38 +1,16 @@
-from isal import igzip as gzip
 from datetime import datetime
 from pathlib import Path
 import requests
 import base64
 import bisect
-import orjson
 import random
 import json
 import time
 
+import by_update_index
 import config
 
 
-def get_file_hashes_of_updates(name, updates):
-    output_dir = config.out_path.joinpath('by_filename_compressed')
-
-    with gzip.open(output_dir.joinpath(f'{name}.json.gz'), 'r') as f:
-        data = orjson.loads(f.read())
-
-    file_hashes = set()
-
-    for file_hash in data:
-        file_updates = set()
-
-        windows_versions = data[file_hash]['windowsVersions']
-        for windows_version in windows_versions:
-            file_updates |= windows_versions[windows_version].keys()
-
-        if any(update in updates for update in file_updates):
-            file_hashes.add(file_hash)
-
-    return file_hashes
-
-
 def create_virustotal_urllib_session():
     # https://stackoverflow.com/a/28002687
     requests.packages.urllib3.disable_warnings(requests.packages.urllib3.exceptions.InsecureRequestWarning)
@@ -271,6 +249,12 @@ def main(time_to_stop=None):
     if progress_next is not None:
         progress_next = tuple(progress_next)
 
+    # The files of the updates are taken from the update index, or from the
+    # data of each file if an update isn't indexed.
+    update_file_hashes = None
+    if progress_updates is not None:
+        update_file_hashes = by_update_index.get_file_hashes_of_updates(progress_updates)
+
     # Get names and hashes of all PE files without full information.
     names_and_hashes = []
     for name in info_sources.keys():
@@ -278,8 +262,10 @@ def main(time_to_stop=None):
         if not file_hashes:
             continue
 
-        if progress_updates is not None:
-            file_hashes &= get_file_hashes_of_updates(name, progress_updates)
+        if update_file_hashes is not None:
+            file_hashes &= update_file_hashes.get(name, set())
+        elif progress_updates is not None:
+            file_hashes &= by_update_index.get_file_hashes_of_updates_from_data(name, progress_updates)
 
         names_and_hashes += [(name, hash) for hash in file_hashes]
 
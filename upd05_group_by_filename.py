@@ -1,43 +1,355 @@
-from typing import Optional, Any
+from typing import Optional, Iterable, Any
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, ALL_COMPLETED, wait
 from multiprocessing import Pool
-from isal import igzip as gzip
-from datetime import datetime
-from itertools import repeat
+from collections import OrderedDict
+from datetime import datetime, timedelta
 from pathlib import Path
 import traceback
+import tempfile
+import queue
+import hashlib
+import sqlite3
 import bisect
 import orjson
+import ijson
 import json
+import os
 
+import by_filename_storage
+import by_update_index
+import validation
+import hash_index
 import config
 
-file_info_data = {}
+# Write-back cache of decoded by_filename data, in least recently used order,
+# keyed by the storage key of the file or of its sub-shard. For each dirty
+# entry, the changed paths are kept in the order in which they were first
+# changed, with the size of their value when it was last measured.
+file_info_data: OrderedDict[str, dict[str, Any]] = OrderedDict()
+file_info_data_sizes: dict[str, int] = {}
+file_info_data_total_size = 0
+file_info_data_dirty: dict[str, dict[tuple[str, ...], int]] = {}
+
+# VirusTotal info computed for file hashes, in least recently used order. It
+# shares the memory budget with the by_filename data.
+virustotal_info_cache: OrderedDict[str, Optional[dict[str, Any]]] = OrderedDict()
+virustotal_info_cache_sizes: dict[str, int] = {}
+virustotal_info_cache_total_size = 0
+
+# Hashes with VirusTotal info which was added with the updates.
+virustotal_info_added: set[str] = set()
+
+# Files and hashes which were added for each update and aren't in the update
+# index yet, see by_update_index.py.
+update_index_pending: dict[str, dict[str, Any]] = {}
+
+# Hashes of files, as (filename, sha256, sha1, md5), which were added or
+# updated and aren't in the hash index yet, see hash_index.py.
+hash_index_pending: set[tuple[str, str, Optional[str], Optional[str]]] = set()
+
+# Cache effectiveness, logged at the end.
+cache_stats: dict[str, int] = dict.fromkeys([
+    'file_info_hits',
+    'file_info_misses',
+    'file_info_spills',
+    'virustotal_info_hits',
+    'virustotal_info_misses',
+    'virustotal_info_spills',
+    'peak_rss',
+], 0)
+memory_budget_checks = 0
+# The max size of the caches after the last check of the RSS.
+cache_max_size: Optional[int] = None
+
+# Objects which are repeated in many files, such as the info of an update,
+# shared by all loaded data. Keyed by their serialized form, so that sharing
+# them doesn't change the key order.
+file_info_data_shared_objects: dict[bytes, dict[str, Any]] = {}
+
+
+def get_memory_budget():
+    # Each worker process has its own caches.
+    return config.memory_budget_mb * 1024 * 1024 // max(config.group_by_filename_processes, 1)
+
+
+def get_rss() -> Optional[int]:
+    try:
+        import psutil
+    except ImportError:
+        psutil = None
+
+    if psutil:
+        return psutil.Process().memory_info().rss
+
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        return None
 
 
-def write_to_gzip_file(file, data):
-    with open(file, 'wb') as fd:
-        with gzip.GzipFile(fileobj=fd, mode='w', compresslevel=config.compression_level, filename='', mtime=0) as gz:
-            gz.write(data)
+def get_cache_max_size():
+    global memory_budget_checks, cache_max_size
 
+    memory_budget_checks += 1
+    if cache_max_size is not None and memory_budget_checks % 100 != 0:
+        return cache_max_size
 
-def write_all_file_info():
-    output_dir = config.out_path.joinpath('by_filename_compressed')
+    max_size = get_memory_budget()
+    cache_max_size = max_size
+
+    rss = get_rss()
+    if rss is None:
+        return max_size
+
+    cache_stats['peak_rss'] = max(cache_stats['peak_rss'], rss)
+
+    # Memory which isn't in the decoded sizes, such as the object overhead
+    # and the updates, leaves less room for the caches. Some room is always
+    # left, otherwise every store would evict everything.
+    if rss > max_size:
+        max_size = max(file_info_data_total_size + virustotal_info_cache_total_size - (rss - max_size),
+                       max_size // 4)
+        cache_max_size = max_size
+
+    return max_size
+
+
+def pop_cache_stats():
+    stats = dict(cache_stats)
+    cache_stats.update(dict.fromkeys(cache_stats, 0))
+    return stats
+
+
+def add_cache_stats(stats: dict[str, int]):
+    for key, value in stats.items():
+        if key == 'peak_rss':
+            cache_stats[key] = max(cache_stats[key], value)
+        else:
+            cache_stats[key] += value
+
+
+def print_cache_stats():
+    rss = get_rss()
+    if rss is not None:
+        cache_stats['peak_rss'] = max(cache_stats['peak_rss'], rss)
+
+    for name, title in [('file_info', 'File info'), ('virustotal_info', 'VirusTotal info')]:
+        hits = cache_stats[f'{name}_hits']
+        misses = cache_stats[f'{name}_misses']
+        if hits + misses == 0:
+            continue
+
+        print(f'{title} cache: {hits} hits, {misses} misses ({hits / (hits + misses):.1%} hit rate),'
+              f' {cache_stats[f"{name}_spills"]} spilled')
+
+    if cache_stats['peak_rss'] > 0:
+        print(f'Peak RSS: {cache_stats["peak_rss"] / 1024 / 1024:.1f} MB'
+              f' (budget: {get_memory_budget() / 1024 / 1024:.1f} MB per process)')
+
+
+def set_file_info_data_size(filename: str, size: int):
+    global file_info_data_total_size
+
+    file_info_data_total_size += size - file_info_data_sizes.get(filename, 0)
+    file_info_data_sizes[filename] = size
+
+
+def evict_file_info_data(filename: str):
+    changed_paths = file_info_data_dirty.pop(filename, None)
+    if changed_paths is not None:
+        by_filename_storage.write_file_info_changes(filename, file_info_data[filename], changed_paths)
+
+    set_file_info_data_size(filename, 0)
+    del file_info_data_sizes[filename]
+    del file_info_data[filename]
+
+
+def get_shared_object(shared_objects: dict[bytes, Any], value: Any):
+    return shared_objects.setdefault(orjson.dumps(value), value)
+
+
+def compact_file_info_data(data: dict[str, Any]):
+    # Decoded data has a separate object for every repetition of the same
+    # value, which adds up for large files. Objects are only shared within
+    # the file unless they're repeated across files.
+    shared_objects = {}
+    shared_strings = {}
+
+    for file_hash_data in data.values():
+        for updates in file_hash_data['windowsVersions'].values():
+            for update_kb, update in updates.items():
+                if update_kb == 'BASE':
+                    update['windowsVersionInfo'] = get_shared_object(file_info_data_shared_objects,
+                                                                     update['windowsVersionInfo'])
+                    continue
+
+                update['updateInfo'] = get_shared_object(file_info_data_shared_objects, update['updateInfo'])
+
+                for assembly in update['assemblies'].values():
+                    assembly['assemblyIdentity'] = get_shared_object(shared_objects, assembly['assemblyIdentity'])
+
+                    for attributes in assembly['attributes']:
+                        for key, value in attributes.items():
+                            if isinstance(value, str):
+                                attributes[key] = shared_strings.setdefault(value, value)
+
+
+def load_file_info_data(filename: str):
+    if filename in file_info_data:
+        file_info_data.move_to_end(filename)
+        cache_stats['file_info_hits'] += 1
+        return file_info_data[filename]
+
+    cache_stats['file_info_misses'] += 1
+
+    data, data_size = by_filename_storage.read_file_info_and_size(filename)
+    if data is None:
+        data = {}
+    elif config.file_info_cache_compact:
+        compact_file_info_data(data)
+
+    file_info_data[filename] = data
+    set_file_info_data_size(filename, data_size)
+
+    return data
+
+
+def mark_file_info_data_changed(filename: str, data: dict[str, Any], changed_paths: Iterable[tuple[str, ...]]):
+    assert file_info_data.get(filename) is data
+
+    file_info_data.move_to_end(filename)
+
+    # The size is measured when loaded, the growth is measured by the size of
+    # the changed values. A value which was loaded is counted again when it's
+    # first changed, which overestimates the size.
+    dirty = file_info_data_dirty.setdefault(filename, {})
+    size = file_info_data_sizes[filename]
+    for path in changed_paths:
+        x = data
+        for path_key in path:
+            x = x[path_key]
+
+        path_size = len(orjson.dumps(x))
+        size += path_size - dirty.get(path, 0)
+        dirty[path] = path_size
+
+    set_file_info_data_size(filename, size)
 
-    for filename in file_info_data:
-        data = file_info_data[filename]
 
-        output_path = output_dir.joinpath(filename + '.json.gz')
-        write_to_gzip_file(output_path, orjson.dumps(data))
+def spill_file_info_data():
+    max_size = get_cache_max_size()
 
-    file_info_data.clear()
+    # VirusTotal info is spilled first, since it's computed again without
+    # writing anything.
+    spill_virustotal_info_cache(max_size)
 
-    all_filenames = sorted(path.with_suffix('').stem for path in output_dir.glob('*.json.gz'))
+    while file_info_data_total_size > max_size and file_info_data:
+        evict_file_info_data(next(iter(file_info_data)))
+        cache_stats['file_info_spills'] += 1
 
-    with open(config.out_path.joinpath('filenames.json'), 'w') as f:
+
+def store_file_info_data(filename: str, data: dict[str, Any], changed_paths: Iterable[tuple[str, ...]]):
+    mark_file_info_data_changed(filename, data, changed_paths)
+    spill_file_info_data()
+
+
+def flush_file_info_data():
+    while file_info_data:
+        evict_file_info_data(next(iter(file_info_data)))
+
+    assert file_info_data_total_size == 0
+    assert file_info_data_dirty == {}
+
+
+def flush_file_info_data_in_threads():
+    # Compression and file writes release the GIL, so the final flush, which
+    # can be large with a large memory budget, is spread over
+    # threads. The in-flight budget is based on the decoded data sizes.
+    max_in_flight_size = config.file_info_write_in_flight_mb * 1024 * 1024
+
+    start_time = datetime.now()
+    written_count = 0
+    written_size = 0
+
+    in_flight = {}
+    in_flight_size = 0
+
+    def wait_for_writes(return_when):
+        nonlocal written_count, written_size, in_flight_size
+
+        done, _ = wait(in_flight, return_when=return_when)
+        for future in done:
+            written_count += 1
+            written_size += future.result()
+            in_flight_size -= in_flight.pop(future)
+
+    with ThreadPoolExecutor(config.file_info_write_threads) as executor:
+        while file_info_data:
+            filename, data = file_info_data.popitem(last=False)
+            changed_paths = file_info_data_dirty.pop(filename, None)
+            size = file_info_data_sizes[filename]
+            set_file_info_data_size(filename, 0)
+            del file_info_data_sizes[filename]
+
+            if changed_paths is None:
+                continue
+
+            while in_flight and in_flight_size + size > max_in_flight_size:
+                wait_for_writes(FIRST_COMPLETED)
+
+            future = executor.submit(by_filename_storage.write_file_info_changes, filename, data, changed_paths)
+            in_flight[future] = size
+            in_flight_size += size
+
+        if in_flight:
+            wait_for_writes(ALL_COMPLETED)
+
+    assert file_info_data_total_size == 0
+    assert file_info_data_dirty == {}
+
+    seconds = (datetime.now() - start_time).total_seconds()
+    if written_count > 0 and seconds > 0:
+        print(f'Wrote {written_count} files, {written_size} bytes in {seconds:.1f} seconds'
+              f' ({written_size / seconds / 1024 / 1024:.1f} MB/s)')
+
+
+def write_all_file_info():
+    if config.file_info_write_threads > 1:
+        flush_file_info_data_in_threads()
+    else:
+        flush_file_info_data()
+
+    by_filename_storage.publish_split_file_info()
+
+    # The catalog is updated by the writers, filenames.json only changes when
+    # names were added or removed.
+    filenames_path = config.out_path.joinpath('filenames.json')
+    if not by_filename_storage.compact_file_info_catalog() and filenames_path.is_file():
+        return
+
+    all_filenames = sorted(by_filename_storage.get_file_info_names())
+
+    with open(filenames_path, 'w') as f:
         json.dump(all_filenames, f, indent=0, sort_keys=True)
 
 
+# The type only depends on the keys and the signing status, and there are few
+# combinations of them.
+file_info_types: dict[tuple, str] = {}
+
+
 def get_file_info_type(file_info: dict[str, Any]):
+    key = (tuple(file_info), file_info.get('signingStatus'))
+    file_info_type = file_info_types.get(key)
+    if file_info_type is None:
+        file_info_type = get_file_info_type_uncached(file_info)
+        file_info_types[key] = file_info_type
+
+    return file_info_type
+
+
+def get_file_info_type_uncached(file_info: dict[str, Any]):
     if 'machineType' not in file_info:
         k = {'size'}
         if k < file_info.keys() <= k | {'md5', 'sha256'}:
@@ -202,6 +514,35 @@ def update_file_info(
     if new_file_info is None:
         return existing_file_info
 
+    # Most merges are of identical info, e.g. for files which are part of many
+    # updates, and the result is the existing info then. The key order is
+    # compared too, since it's kept in the output.
+    if new_file_info is existing_file_info or (
+        new_file_info == existing_file_info
+        and list(new_file_info) == list(existing_file_info)
+    ):
+        updated_file_info = existing_file_info
+    else:
+        updated_file_info = merge_file_info(existing_file_info, new_file_info, new_file_info_source)
+
+    if config.update_file_info_verify:
+        expected_file_info = merge_file_info(existing_file_info, new_file_info, new_file_info_source)
+        assert orjson.dumps(updated_file_info) == orjson.dumps(expected_file_info), (
+            existing_file_info,
+            new_file_info,
+            new_file_info_source,
+        )
+
+    return updated_file_info
+
+
+def merge_file_info(
+    existing_file_info: dict[str, Any],
+    new_file_info: dict[str, Any],
+    new_file_info_source: str,
+):
+    # Always validated, the check is cheaper than a lookup in the validation
+    # store.
     assert_file_info_close_enough(existing_file_info, new_file_info)
 
     if new_file_info_source == 'iso':
@@ -307,6 +648,7 @@ def add_file_info_from_update(
     assembly_identity: dict[str, Any],
     attributes: dict[str, Any],
     delta_or_pe_file_info: Optional[dict[str, Any]],
+    attributes_index: Optional[dict[int, tuple[list, set]]] = None,
 ):
     x = data.setdefault(file_hash, {})
 
@@ -321,29 +663,168 @@ def add_file_info_from_update(
 
     if 'updateInfo' not in x:
         x['updateInfo'] = update_info
-    else:
+    elif x['updateInfo'] is not update_info:
         assert x['updateInfo'] == update_info, (x['updateInfo'], update_info)
+        # Share the object so that the next comparisons are trivial, unless
+        # its keys are in a different order, which would change the output.
+        if orjson.dumps(x['updateInfo']) == orjson.dumps(update_info):
+            x['updateInfo'] = update_info
 
     x = x.setdefault('assemblies', {})
     x = x.setdefault(manifest_name, {})
 
     if 'assemblyIdentity' not in x:
         x['assemblyIdentity'] = assembly_identity
-    else:
+    elif x['assemblyIdentity'] is not assembly_identity:
         assert x['assemblyIdentity'] == assembly_identity
+        if orjson.dumps(x['assemblyIdentity']) == orjson.dumps(assembly_identity):
+            x['assemblyIdentity'] = assembly_identity
 
     x = x.setdefault('attributes', [])
 
-    if attributes not in x:
+    if attributes_index is None:
+        if attributes not in x:
+            x.append(attributes)
+        return data
+
+    # Avoid a linear scan of the list for files which are part of many
+    # assemblies. The list is kept in the index to keep its id valid.
+    attributes_key = get_attributes_key(attributes)
+    if id(x) in attributes_index:
+        _, attributes_keys = attributes_index[id(x)]
+    else:
+        attributes_keys = {get_attributes_key(item) for item in x}
+        attributes_index[id(x)] = (x, attributes_keys)
+
+    if attributes_key not in attributes_keys:
+        attributes_keys.add(attributes_key)
         x.append(attributes)
 
     return data
 
 
-virustotal_info_cache: dict[str, Any] = {}
+def get_attributes_key(attributes: dict[str, Any]):
+    return tuple(sorted(attributes.items()))
+
+
+# Connection to the VirusTotal info index and the process that opened it.
+virustotal_info_index_connection: Optional[tuple[int, sqlite3.Connection]] = None
+
+
+def get_virustotal_info_index_fingerprint():
+    # The computed info depends on these, the index is rebuilt if they change.
+    values = [
+        1,  # Bump if get_virustotal_info_from_file() changes.
+        sorted(config.tcb_launcher_descriptions),
+        sorted(config.tcb_launcher_large_first_section_virtual_addresses),
+        sorted(config.file_hashes_unusual_section_alignment.items()),
+        sorted(config.file_hashes_zero_timestamp),
+        sorted(config.file_hashes_small_non_signature_overlay),
+        sorted(config.file_hashes_unsigned_with_overlay),
+        config.file_details_unsigned_with_overlay,
+    ]
+    return hashlib.sha256(repr(values).encode()).hexdigest()
+
+
+def get_virustotal_info_index():
+    global virustotal_info_index_connection
+
+    if not config.virustotal_info_index_path:
+        return None
+
+    # SQLite connections can't be used in forked worker processes.
+    if virustotal_info_index_connection and virustotal_info_index_connection[0] == os.getpid():
+        return virustotal_info_index_connection[1]
+
+    config.virustotal_info_index_path.parent.mkdir(parents=True, exist_ok=True)
+    connection = sqlite3.connect(config.virustotal_info_index_path, timeout=60)
+    virustotal_info_index_connection = (os.getpid(), connection)
+    return connection
+
+
+def init_virustotal_info_index():
+    connection = get_virustotal_info_index()
+    if not connection:
+        return
+
+    with connection:
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        connection.execute('CREATE TABLE IF NOT EXISTS info (hash TEXT PRIMARY KEY, info BLOB)')
+
+        fingerprint = get_virustotal_info_index_fingerprint()
+        row = connection.execute("SELECT value FROM meta WHERE key = 'fingerprint'").fetchone()
+        if row is None or row[0] != fingerprint:
+            connection.execute('DELETE FROM info')
+            connection.execute("INSERT OR REPLACE INTO meta VALUES ('fingerprint', ?)", (fingerprint,))
+
+
+def get_virustotal_info_from_index(file_hash: str):
+    connection = get_virustotal_info_index()
+    if not connection:
+        return None
+
+    row = connection.execute('SELECT info FROM info WHERE hash = ?', (file_hash,)).fetchone()
+    if row is None:
+        return None
+
+    return orjson.loads(row[0])
+
+
+def add_virustotal_info_to_index(file_hash: str, info: dict[str, Any]):
+    connection = get_virustotal_info_index()
+    if not connection:
+        return
+
+    # A zero timestamp might have been allowed only for the target filename.
+    if info['timestamp'] == 0 and file_hash not in config.file_hashes_zero_timestamp:
+        return
+
+    with connection:
+        connection.execute('INSERT OR REPLACE INTO info VALUES (?, ?)', (file_hash, orjson.dumps(info)))
+
+
+def spill_virustotal_info_cache(max_size: int):
+    global virustotal_info_cache_total_size
+
+    while file_info_data_total_size + virustotal_info_cache_total_size > max_size and virustotal_info_cache:
+        file_hash, _ = virustotal_info_cache.popitem(last=False)
+        virustotal_info_cache_total_size -= virustotal_info_cache_sizes.pop(file_hash)
+        cache_stats['virustotal_info_spills'] += 1
 
 
 def get_virustotal_info(target_filename: str, file_hash: str):
+    global virustotal_info_cache_total_size
+
+    if file_hash in virustotal_info_cache:
+        virustotal_info_cache.move_to_end(file_hash)
+        cache_stats['virustotal_info_hits'] += 1
+        return virustotal_info_cache[file_hash]
+
+    cache_stats['virustotal_info_misses'] += 1
+
+    # Missing files aren't indexed, they might be downloaded later.
+    info = get_virustotal_info_from_index(file_hash)
+    if info is None:
+        info = get_virustotal_info_from_file(target_filename, file_hash)
+        if info is not None:
+            add_virustotal_info_to_index(file_hash, info)
+
+    if info is not None:
+        virustotal_info_added.add(file_hash)
+
+    size = len(orjson.dumps(info))
+    virustotal_info_cache[file_hash] = info
+    virustotal_info_cache_sizes[file_hash] = size
+    virustotal_info_cache_total_size += size
+
+    # The by_filename data can't be spilled here, it might be in use.
+    spill_virustotal_info_cache(get_cache_max_size())
+
+    return info
+
+
+def get_virustotal_info_from_file(target_filename: str, file_hash: str):
     # https://stackoverflow.com/a/57027610
     def is_power_of_two(n):
         return (n != 0) and (n & (n-1) == 0)
@@ -351,9 +832,6 @@ def get_virustotal_info(target_filename: str, file_hash: str):
     def align_by(n, alignment):
         return ((n + alignment - 1) // alignment) * alignment
 
-    if config.high_mem_usage_for_performance and file_hash in virustotal_info_cache:
-        return virustotal_info_cache[file_hash]
-
     if len(file_hash) == 64:
         # SHA256, the default.
         source_dir = 'virustotal'
@@ -364,12 +842,15 @@ def get_virustotal_info(target_filename: str, file_hash: str):
 
     filename = config.out_path.joinpath(source_dir, file_hash + '.json')
     if not filename.is_file():
-        if config.high_mem_usage_for_performance:
-            virustotal_info_cache[file_hash] = None
         return None
 
-    with open(filename) as f:
-        data = json.load(f)
+    data_bytes = filename.read_bytes()
+    data = json.loads(data_bytes)
+
+    # The special cases below depend on the config.
+    validation_key = validation.get_content_key(target_filename, data_bytes.decode(),
+                                                get_virustotal_info_index_fingerprint())
+    validate = validation.should_validate('virustotal_info', validation_key)
 
     attr = data['data']['attributes']
 
@@ -377,27 +858,32 @@ def get_virustotal_info(target_filename: str, file_hash: str):
 
     # Handle special cases.
     if attr.get('signature_info', {}).get('description') in config.tcb_launcher_descriptions:
-        assert first_section['virtual_address'] in config.tcb_launcher_large_first_section_virtual_addresses, file_hash
+        if validate:
+            assert first_section['virtual_address'] in config.tcb_launcher_large_first_section_virtual_addresses, file_hash
         section_alignment = 0x1000
     elif unusual_section_alignment_info := config.file_hashes_unusual_section_alignment.get(file_hash):
-        assert first_section['virtual_address'] == unusual_section_alignment_info['first_section_virtual_address']
+        if validate:
+            assert first_section['virtual_address'] == unusual_section_alignment_info['first_section_virtual_address']
         section_alignment = unusual_section_alignment_info['section_alignment']
     else:
         section_alignment = first_section['virtual_address']
-        assert is_power_of_two(section_alignment), file_hash
+        if validate:
+            assert is_power_of_two(section_alignment), file_hash
 
     virtual_size = first_section['virtual_address']
     for section in attr['pe_info']['sections']:
-        assert virtual_size == section['virtual_address'], file_hash
+        if validate:
+            assert virtual_size == section['virtual_address'], file_hash
         virtual_size += align_by(section['virtual_size'], section_alignment)
 
     if 'timestamp' in attr['pe_info']:
         timestamp = attr['pe_info']['timestamp']
     else:
-        assert (
-            target_filename in config.file_names_zero_timestamp or
-            file_hash in config.file_hashes_zero_timestamp
-        ), (target_filename, file_hash)
+        if validate:
+            assert (
+                target_filename in config.file_names_zero_timestamp or
+                file_hash in config.file_hashes_zero_timestamp
+            ), (target_filename, file_hash)
         timestamp = 0
 
     info = {
@@ -414,7 +900,8 @@ def get_virustotal_info(target_filename: str, file_hash: str):
     if 'overlay' in attr['pe_info']:
         overlay_size = attr['pe_info']['overlay']['size']
         if overlay_size < 0x20:
-            assert file_hash in config.file_hashes_small_non_signature_overlay, file_hash
+            if validate:
+                assert file_hash in config.file_hashes_small_non_signature_overlay, file_hash
         elif file_hash in config.file_hashes_unsigned_with_overlay:
             pass
         elif any(attr.get('signature_info', {}).get(x['k']) == x['v'] and overlay_size == x['overlay_size']
@@ -453,7 +940,8 @@ def get_virustotal_info(target_filename: str, file_hash: str):
                 # 13:18 21/02/2020
                 date_format = '%H:%M %d/%m/%Y'
             else:
-                assert spaces == 2, file_hash
+                if validate:
+                    assert spaces == 2, file_hash
                 # Examples:
                 # 8:30 AM 2/7/2020
                 # 5:47 PM 9/19/2019
@@ -465,14 +953,12 @@ def get_virustotal_info(target_filename: str, file_hash: str):
             # If this assertion fails, the "signing date" might be the analysis
             # date, in which case the signature type is "Catalog file", and
             # has_signature_overlay should be False.
-            assert datetime_object.timestamp() < attr['first_submission_date'], file_hash
-
-    assert not has_signature_overlay or file_signed, file_hash
+            if validate:
+                assert datetime_object.timestamp() < attr['first_submission_date'], file_hash
 
-    if config.high_mem_usage_for_performance:
-        virustotal_info_cache[file_hash] = info
-    else:
-        virustotal_info_cache[file_hash] = True
+    if validate:
+        assert not has_signature_overlay or file_signed, file_hash
+        validation.set_validated('virustotal_info', validation_key)
 
     return info
 
@@ -480,21 +966,20 @@ def get_virustotal_info(target_filename: str, file_hash: str):
 def group_update_assembly_by_filename(
     filename: str,
     file_manifest_data: list[dict[str, Any]],
-    output_dir: Path,
     *,
     windows_version: str,
     update_kb: str,
     update_info: dict[str, Any],
 ):
-    if filename in file_info_data:
-        data = file_info_data[filename]
-    else:
-        output_path = output_dir.joinpath(filename + '.json.gz')
-        if output_path.is_file():
-            with gzip.open(output_path, 'rb') as f:
-                data = orjson.loads(f.read())
-        else:
-            data = {}
+    data_by_key = {}
+    changed_paths_by_key = {}
+    new_file_hashes = {}
+    update_file_hashes = {}
+    attributes_index = {}
+
+    if not by_filename_storage.is_file_info_split(filename):
+        data_by_key[filename] = load_file_info_data(filename)
+        changed_paths_by_key[filename] = {}
 
     for item in file_manifest_data:
         file_hash_sha256 = item['file_hash_sha256']
@@ -532,6 +1017,19 @@ def group_update_assembly_by_filename(
             print(f'         Manifest name: {manifest_name}')
             continue
 
+        key = by_filename_storage.get_file_info_key(filename, file_hash)
+        if key not in data_by_key:
+            data_by_key[key] = load_file_info_data(key)
+            changed_paths_by_key[key] = {}
+
+        data = data_by_key[key]
+        changed_paths = changed_paths_by_key[key]
+
+        if file_hash not in data:
+            new_file_hashes[file_hash] = None
+
+        file_info = data.get(file_hash, {}).get('fileInfo')
+
         data = add_file_info_from_update(data,
             file_hash=file_hash,
             virustotal_file_info=virustotal_info,
@@ -541,22 +1039,40 @@ def group_update_assembly_by_filename(
             manifest_name=manifest_name,
             assembly_identity=assembly_identity,
             attributes=attributes,
-            delta_or_pe_file_info=delta_or_pe_file_info)
+            delta_or_pe_file_info=delta_or_pe_file_info,
+            attributes_index=attributes_index)
 
-    if config.high_mem_usage_for_performance:
-        file_info_data[filename] = data
-    else:
-        output_path = output_dir.joinpath(filename + '.json.gz')
-        write_to_gzip_file(output_path, orjson.dumps(data))
+        if data[file_hash].get('fileInfo') is not file_info:
+            changed_paths[(file_hash, 'fileInfo')] = None
+
+        changed_paths[(file_hash, 'windowsVersions', windows_version, update_kb)] = None
+        update_file_hashes[file_hash] = None
+        add_hash_index_pending(filename, file_hash, data[file_hash])
+
+    by_filename_storage.add_file_info_hashes(filename, list(new_file_hashes))
+
+    if update_file_hashes:
+        by_update_index.add_to_update_index(update_index_pending.setdefault(update_kb, {}),
+                                            update_info['created'], {filename: update_file_hashes})
+
+    # All of the keys are marked before spilling, spilling could write or drop
+    # keys which weren't marked yet.
+    for key, data in data_by_key.items():
+        mark_file_info_data_changed(key, data, changed_paths_by_key[key])
+
+    spill_file_info_data()
 
 
 def get_file_details_from_assembly(assembly_path: Path):
     with open(assembly_path) as f:
         data = json.load(f)
 
+    return get_file_details_from_parsed_manifest(assembly_path.stem, data)
+
+
+def get_file_details_from_parsed_manifest(manifest_name: str, data: dict[str, Any]):
     result = {}
 
-    manifest_name = assembly_path.stem
     assembly_identity = data['assemblyIdentity']
 
     for file_item in data['files']:
@@ -575,56 +1091,364 @@ def get_file_details_from_assembly(assembly_path: Path):
     return result
 
 
-def group_update_assembly_by_filename_worker(
-    filename: str,
-    file_details: list[dict[str, Any]],
-    output_dir: Path,
+def add_parsed_manifest_file_details(
+    parsed_file_details: dict[str, dict[str, dict[str, list[dict[str, Any]]]]],
     windows_version: str,
     update_kb: str,
-    update: dict[str, Any],
-    time_to_stop: Optional[datetime],
+    manifest_name: str,
+    data: dict[str, Any],
 ):
-    if time_to_stop and datetime.now() >= time_to_stop:
+    file_details_from_assembly = parsed_file_details.setdefault(windows_version, {}).setdefault(update_kb, {})
+
+    details = get_file_details_from_parsed_manifest(manifest_name, data)
+    for filename, file_details in details.items():
+        file_details_from_assembly.setdefault(filename, []).extend(file_details)
+
+
+# State of a worker process, set once per run by init_worker().
+worker_state: dict[str, Any] = {}
+
+
+def init_worker(time_to_stop: Optional[datetime]):
+    updates_path = config.out_path.joinpath('updates.json')
+    if updates_path.is_file():
+        with open(updates_path) as f:
+            updates = json.load(f)
+    else:
+        updates = {}
+
+    worker_state['updates'] = updates
+    worker_state['time_to_stop'] = time_to_stop
+    worker_state['last_flush_time'] = datetime.now()
+
+
+def flush_worker(_=None):
+    flush_file_info_data()
+    worker_state['last_flush_time'] = datetime.now()
+
+    validation.flush_validated()
+
+    return pop_worker_results()
+
+
+def flush_worker_if_needed():
+    # Processed files are only saved as processed after they're written, see
+    # group_updates_by_filename().
+    if datetime.now() - worker_state['last_flush_time'] < timedelta(seconds=config.group_by_filename_checkpoint_interval):
         return False
 
-    group_update_assembly_by_filename(filename, file_details, output_dir,
-                                      windows_version=windows_version,
-                                      update_kb=update_kb,
-                                      update_info=update)
+    flush_file_info_data()
+    worker_state['last_flush_time'] = datetime.now()
     return True
 
 
-def group_update_by_filename(
-    windows_version: str,
-    update_kb: str,
-    update: dict[str, Any],
-    parsed_dir: Path,
+# Worker processes which keep their cache of the by_filename data between
+# tasks and stages. Each worker has a pool of its own, so that the tasks of a
+# file always go to the same worker, which might have its data cached. Two
+# workers must never have the data of the same file.
+def create_workers(processes: int, time_to_stop: Optional[datetime]):
+    return {
+        'pools': [Pool(1, initializer=init_worker, initargs=(time_to_stop,)) for _ in range(processes)],
+        'costs': [0] * processes,
+        'files': {},
+    }
+
+
+def close_workers(workers: dict[str, Any]):
+    for pool in workers['pools']:
+        pool.terminate()
+        pool.join()
+
+
+def get_file_worker(workers: dict[str, Any], filename: str, cost: int):
+    worker = workers['files'].get(filename)
+    if worker is None:
+        worker = min(range(len(workers['pools'])), key=lambda i: workers['costs'][i])
+        workers['files'][filename] = worker
+
+    workers['costs'][worker] += cost
+    return worker
+
+
+def get_worker_tasks(workers: dict[str, Any], items: list[tuple[int, str, Any]]):
+    # Items are (cost, filename, item), the largest files are assigned first
+    # to balance the workers. Tasks are (worker, items).
+    items_of_workers = {}
+    for cost, filename, item in sorted(items, key=lambda x: x[0], reverse=True):
+        worker = get_file_worker(workers, filename, cost)
+        items_of_workers.setdefault(worker, []).append((cost, item))
+
+    tasks = []
+    for worker, worker_items in items_of_workers.items():
+        tasks += [(worker, task_items) for task_items in get_balanced_tasks(worker_items, 1)]
+
+    return tasks
+
+
+def imap_workers(workers: dict[str, Any], func, tasks: list[tuple[int, Any]]):
+    # Yields (worker, result) in the order in which the tasks are done.
+    results = queue.Queue()
+    for worker, task in tasks:
+        workers['pools'][worker].apply_async(
+            func, (task,),
+            callback=lambda result, worker=worker: results.put((worker, result, None)),
+            error_callback=lambda error, worker=worker: results.put((worker, None, error)))
+
+    for _ in tasks:
+        worker, result, error = results.get()
+        if error is not None:
+            raise error
+
+        yield worker, result
+
+
+def flush_workers(workers: dict[str, Any]):
+    tasks = [(worker, None) for worker in range(len(workers['pools']))]
+    for _, worker_results in imap_workers(workers, flush_worker, tasks):
+        add_worker_results(worker_results)
+
+
+def add_hash_index_pending(filename: str, file_hash: str, file_hash_data: dict[str, Any]):
+    sha1, md5 = hash_index.get_file_info_hashes(file_hash_data.get('fileInfo'))
+    hash_index_pending.add((filename, file_hash, sha1, md5))
+
+
+def flush_update_index():
+    by_update_index.add_update_indexes(update_index_pending)
+    update_index_pending.clear()
+
+
+def flush_hash_index():
+    hash_index.update_hash_index(sorted(hash_index_pending, key=lambda item: (item[0], item[1])))
+    hash_index_pending.clear()
+
+
+def pop_worker_results():
+    # The parent process doesn't see the global state of the worker process,
+    # it's merged with add_worker_results().
+    worker_results = {
+        'virustotal_info_added': list(virustotal_info_added),
+        'update_index': dict(update_index_pending),
+        'hash_index': list(hash_index_pending),
+        'write_counts': by_filename_storage.pop_write_counts(),
+        'cache_stats': pop_cache_stats(),
+    }
+
+    virustotal_info_added.clear()
+    update_index_pending.clear()
+    hash_index_pending.clear()
+
+    return worker_results
+
+
+def add_worker_results(worker_results: dict[str, Any]):
+    virustotal_info_added.update(worker_results['virustotal_info_added'])
+
+    for update_kb, index in worker_results['update_index'].items():
+        by_update_index.add_to_update_index(update_index_pending.setdefault(update_kb, {}),
+                                            index['created'], index['files'])
+
+    hash_index_pending.update(worker_results['hash_index'])
+    by_filename_storage.add_write_counts(worker_results['write_counts'])
+    add_cache_stats(worker_results['cache_stats'])
+
+
+def group_file_updates_by_filename(
+    filename: str,
+    file_updates: list[tuple[str, str, list[dict[str, Any]]]],
+    updates: dict[str, dict[str, dict[str, Any]]],
+):
+    # The data stays in the cache between the updates, so that it's loaded and
+    # written once for all updates of a batch.
+    for windows_version, update_kb, file_details in file_updates:
+        group_update_assembly_by_filename(filename, file_details,
+                                          windows_version=windows_version,
+                                          update_kb=update_kb,
+                                          update_info=updates[windows_version][update_kb])
+
+
+def group_file_updates_by_filename_worker(
+    files: list[tuple[str, list[tuple[str, str, list[dict[str, Any]]]]]],
+):
+    updates = worker_state['updates']
+    time_to_stop = worker_state['time_to_stop']
+
+    results = []
+    for filename, file_updates in files:
+        if time_to_stop and datetime.now() >= time_to_stop:
+            results.append((filename, False, None, 0))
+            continue
+
+        start_time = datetime.now()
+
+        try:
+            group_file_updates_by_filename(filename, file_updates, updates)
+            result, error = True, None
+        except Exception:
+            result, error = False, traceback.format_exc()
+
+        results.append((filename, result, error, (datetime.now() - start_time).total_seconds()))
+
+    # The data stays in the cache of the worker for the next stages.
+    flushed = flush_worker_if_needed()
+
+    validation.flush_validated()
+
+    return results, flushed, pop_worker_results()
+
+
+def get_file_task_cost(filename: str, item_count: int):
+    cost = item_count * 100
+
+    output_path = by_filename_storage.get_file_info_path(filename)
+    if output_path.is_file():
+        cost += output_path.stat().st_size
+
+    return cost
+
+
+def get_balanced_tasks(items: list[tuple[int, Any]], processes: int):
+    items = sorted(items, key=lambda x: x[0], reverse=True)
+
+    # Large files come first and get a task of their own, so that they don't
+    # end up being processed alone at the end. Small files are batched to
+    # reduce the overhead, with enough tasks per process to balance the tail.
+    target_cost = sum(cost for cost, _ in items) / (processes * 16)
+
+    tasks = []
+    task_items = []
+    task_cost = 0
+    for cost, item in items:
+        task_items.append(item)
+        task_cost += cost
+        if task_cost >= target_cost:
+            tasks.append(task_items)
+            task_items = []
+            task_cost = 0
+
+    if task_items:
+        tasks.append(task_items)
+
+    return tasks
+
+
+
+def get_cost_model_path():
+    return config.temp_path.joinpath('winbindex_upd05_cost_model.json')
+
+
+def get_seconds_per_cost():
+    cost_model_path = get_cost_model_path()
+    if cost_model_path.is_file():
+        with open(cost_model_path) as f:
+            return json.load(f)['secondsPerCost']
+
+    return config.group_by_filename_seconds_per_cost
+
+
+def learn_seconds_per_cost(cost: int, seconds: float):
+    # Short runs are mostly overhead.
+    if seconds < 1:
+        return
+
+    # Favor recent measurements, the speed depends on the machine.
+    seconds_per_cost = (get_seconds_per_cost() + seconds / cost) / 2
+
+    config.temp_path.mkdir(parents=True, exist_ok=True)
+    with open(get_cost_model_path(), 'w') as f:
+        json.dump({'secondsPerCost': seconds_per_cost}, f, indent=4)
+
+
+def schedule_files(
+    file_costs: dict[str, int],
+    time_to_stop: Optional[datetime],
+    processes: int,
+    seconds_per_cost: float,
+):
+    files = sorted(file_costs, key=lambda filename: file_costs[filename])
+
+    if time_to_stop:
+        # Select the cheapest files first to complete as many files as
+        # possible in the remaining time.
+        max_cost = (time_to_stop - datetime.now()).total_seconds() * processes / seconds_per_cost
+
+        selected_count = 0
+        selected_cost = 0
+        for filename in files:
+            if selected_cost + file_costs[filename] > max_cost:
+                break
+
+            selected_count += 1
+            selected_cost += file_costs[filename]
+
+        # Always make progress, otherwise a file which never fits would be
+        # deferred forever.
+        files = files[:max(selected_count, 1)]
+
+    # With multiple processes, the longest file bounds the total time.
+    total_cost = sum(file_costs[filename] for filename in files)
+    longest_cost = max((file_costs[filename] for filename in files), default=0)
+    seconds = max(total_cost / processes, longest_cost) * seconds_per_cost
+
+    return files, datetime.now() + timedelta(seconds=seconds)
+
+
+def save_progress_state(progress_state: dict[str, Any], progress_file: Path):
+    with open(progress_file, 'w') as f:
+        json.dump(progress_state, f, indent=4)
+
+
+def get_update_sort_key(updates: dict[str, dict[str, Any]], update_kb: str):
+    for windows_version, windows_version_updates in updates.items():
+        if update_kb in windows_version_updates:
+            update_info = windows_version_updates[update_kb]
+            if windows_version == 'builds':
+                return update_info['created'], update_info['build'], update_kb
+            else:
+                return update_info['releaseDate'], update_info['releaseVersion'], update_kb
+    assert False, update_kb
+
+
+def group_updates_by_filename(
+    updates: dict[str, dict[str, dict[str, Any]]],
+    update_sources: list[tuple[str, str, Optional[Path], Optional[dict[str, list[dict[str, Any]]]]]],
     progress_state: Optional[dict[str, Any]] = None,
     time_to_stop: Optional[datetime] = None,
+    *,
+    workers: Optional[dict[str, Any]] = None,
+    progress_file: Optional[Path] = None,
 ):
-    output_dir = config.out_path.joinpath('by_filename_compressed')
-    output_dir.mkdir(parents=True, exist_ok=True)
+    by_filename_storage.get_output_dir().mkdir(parents=True, exist_ok=True)
 
     if progress_state:
-        assert progress_state['update_kb'] == update_kb
+        assert {update_kb for _, update_kb, _, _ in update_sources} <= set(progress_state['update_kbs'])
         files_processed = set(progress_state['files_processed'])
     else:
         files_processed = set()
 
-    file_details_from_assembly = {}
-    for path in parsed_dir.glob('*.json'):
-        if path.is_dir():
-            continue
+    # The updates of each file, in the order of the updates.
+    file_updates = {}
+    for windows_version, update_kb, parsed_dir, parsed_file_details in update_sources:
+        if parsed_file_details is not None:
+            file_details_from_assembly = parsed_file_details
+        else:
+            file_details_from_assembly = {}
+            for path in parsed_dir.glob('*.json'):
+                if path.is_dir():
+                    continue
+
+                details = get_file_details_from_assembly(path)
+                for filename, file_details in details.items():
+                    file_details_from_assembly.setdefault(filename, []).extend(file_details)
 
-        details = get_file_details_from_assembly(path)
-        for filename, file_details in details.items():
+        for filename, file_details in file_details_from_assembly.items():
             if filename in files_processed:
                 continue
 
-            file_details_from_assembly.setdefault(filename, []).extend(file_details)
+            file_updates.setdefault(filename, []).append((windows_version, update_kb, file_details))
 
     if progress_state:
-        files_unprocessed_count = len(file_details_from_assembly)
+        files_unprocessed_count = len(file_updates)
 
         if progress_state['files_total'] is None:
             assert files_processed == set()
@@ -632,44 +1456,113 @@ def group_update_by_filename(
         else:
             assert progress_state['files_total'] == len(files_processed) + files_unprocessed_count
 
-    processes = config.group_by_filename_processes
-    if processes > 1:
+    processes = len(workers['pools']) if workers else 1
+
+    file_costs = {}
+    for filename, updates_of_file in file_updates.items():
+        item_count = sum(len(file_details) for _, _, file_details in updates_of_file)
+        file_costs[filename] = get_file_task_cost(filename, item_count)
+
+    seconds_per_cost = get_seconds_per_cost()
+    scheduled_files, projected_finish_time = schedule_files(file_costs, time_to_stop, processes, seconds_per_cost)
+
+    deferred_count = len(file_updates) - len(scheduled_files)
+    if deferred_count > 0:
+        print(f'  Deferring {deferred_count} of {len(file_updates)} files to the next run,'
+              f' not enough time left')
+        file_updates = {filename: file_updates[filename] for filename in scheduled_files}
+
+    print(f'  Processing {len(scheduled_files)} files,'
+          f' projected to finish at {projected_finish_time.strftime("%Y-%m-%d %H:%M:%S")}')
+
+    processed_cost = 0
+    processed_seconds = 0
+
+    last_checkpoint_time = datetime.now()
+
+    def checkpoint():
+        nonlocal last_checkpoint_time
+
+        if not progress_state or not progress_file:
+            return
+
+        if datetime.now() - last_checkpoint_time < timedelta(seconds=config.group_by_filename_checkpoint_interval):
+            return
+
+        # Processed files must be on disk before they're saved as processed.
+        flush_file_info_data()
+        flush_update_index()
+        flush_hash_index()
+
+        progress_state['files_processed'] = sorted(files_processed)
+        save_progress_state(progress_state, progress_file)
+        last_checkpoint_time = datetime.now()
+
+    if workers:
         # Global state is not shared between processes.
-        assert not config.high_mem_usage_for_performance
         assert file_info_data == {}
 
-        with Pool(processes) as pool:
-            results = pool.starmap(group_update_assembly_by_filename_worker, zip(
-                file_details_from_assembly.keys(),
-                file_details_from_assembly.values(),
-                repeat(output_dir),
-                repeat(windows_version),
-                repeat(update_kb),
-                repeat(update),
-                repeat(time_to_stop),
-            ))
-            file_details_from_assembly_results = dict(zip(file_details_from_assembly.keys(), results))
-
-            for filename, result in file_details_from_assembly_results.items():
-                if result:
-                    files_processed.add(filename)
+        # Files which were processed by each worker and might not be written
+        # yet, they're saved as processed once the worker flushed its cache.
+        files_unflushed = [set() for _ in workers['pools']]
+
+        items = [(file_costs[filename], filename, (filename, updates_of_file))
+                 for filename, updates_of_file in file_updates.items()]
+        tasks = get_worker_tasks(workers, items)
+        for worker, (results, flushed, worker_results) in imap_workers(
+                workers, group_file_updates_by_filename_worker, tasks):
+            # Including which VirusTotal info was already added.
+            add_worker_results(worker_results)
+
+            for filename, result, error, seconds in results:
+                if error:
+                    print(f'ERROR: failed to process {filename}')
+                    print(f'       {error}')
+                    if config.exit_on_first_error:
+                        raise Exception(f'Failed to process {filename}')
+                elif result:
+                    files_unflushed[worker].add(filename)
+                    processed_cost += file_costs[filename]
+                    processed_seconds += seconds
+
+            if flushed:
+                files_processed.update(files_unflushed[worker])
+                files_unflushed[worker].clear()
+
+            checkpoint()
+
+        # The rest is written by the end of the run, as in a single process.
+        for worker_files in files_unflushed:
+            files_processed.update(worker_files)
     else:
-        for filename, file_details in file_details_from_assembly.items():
+        # The cheapest files first, to complete as many files as possible if
+        # the estimate is off.
+        for filename in scheduled_files:
             if time_to_stop and datetime.now() >= time_to_stop:
                 break
 
+            start_time = datetime.now()
+
             try:
-                group_update_assembly_by_filename(filename, file_details, output_dir,
-                                                  windows_version=windows_version,
-                                                  update_kb=update_kb,
-                                                  update_info=update)
+                group_file_updates_by_filename(filename, file_updates[filename], updates)
                 files_processed.add(filename)
+                processed_cost += file_costs[filename]
+                processed_seconds += (datetime.now() - start_time).total_seconds()
             except Exception as e:
                 print(f'ERROR: failed to process {filename}')
                 print(f'       {e}')
                 if config.exit_on_first_error:
                     raise
 
+            checkpoint()
+
+    if processed_cost > 0:
+        learn_seconds_per_cost(processed_cost, processed_seconds)
+
+    # Written by the parent process only. If interrupted before it's written,
+    # the files aren't saved as processed and are added to it again.
+    flush_update_index()
+
     if progress_state:
         progress_state['files_processed'] = sorted(files_processed)
 
@@ -677,6 +1570,10 @@ def group_update_by_filename(
 def process_updates(
     progress_state: Optional[dict[str, Any]] = None,
     time_to_stop: Optional[datetime] = None,
+    parsed_file_details: Optional[dict[str, dict[str, dict[str, list[dict[str, Any]]]]]] = None,
+    *,
+    workers: Optional[dict[str, Any]] = None,
+    progress_file: Optional[Path] = None,
 ):
     updates_path = config.out_path.joinpath('updates.json')
     if updates_path.is_file():
@@ -685,50 +1582,88 @@ def process_updates(
     else:
         updates = {}
 
+    # All updates are grouped together, each file is processed once for all of
+    # its updates.
+    update_sources = []
     for windows_version in updates:
-        print(f'Processing Windows version {windows_version}:')
-
         for update_kb in updates[windows_version]:
-            update = updates[windows_version][update_kb]
+            # Parsed manifests were handed over in memory by upd03.
+            if parsed_file_details is not None:
+                update_file_details = parsed_file_details.get(windows_version, {}).get(update_kb)
+                if update_file_details is not None:
+                    update_sources.append((windows_version, update_kb, None, update_file_details))
+                continue
 
             parsed_dir = config.out_path.joinpath('parsed', windows_version, update_kb)
             if parsed_dir.is_dir():
-                group_update_by_filename(windows_version, update_kb, update, parsed_dir, progress_state, time_to_stop)
-                print('  ' + update_kb)
+                update_sources.append((windows_version, update_kb, parsed_dir, None))
+
+    # In the order in which they'd be processed one at a time, which sets the
+    # order of the updates in the data.
+    update_sources.sort(key=lambda source: get_update_sort_key(updates, source[1]))
+
+    for windows_version, update_kb, _, _ in update_sources:
+        print(f'  {windows_version}: {update_kb}')
+
+    if update_sources:
+        group_updates_by_filename(updates, update_sources, progress_state, time_to_stop,
+                                  workers=workers, progress_file=progress_file)
 
     if progress_state and progress_state['files_total'] is None:
         progress_state['files_total'] = 0
 
 
-def add_file_info_from_virustotal_data(
-    filename: str, output_dir: Path, *, file_hash: str, file_info: dict[str, Any]
-):
-    if filename in file_info_data:
-        data = file_info_data[filename]
-    else:
-        output_path = output_dir.joinpath(filename + '.json.gz')
-        if output_path.is_file():
-            with gzip.open(output_path, 'rb') as f:
-                data = orjson.loads(f.read())
-        else:
-            data = {}
+def add_file_info_from_virustotal_data(filename: str, file_hashes: list[str]):
+    data_by_key = {}
+    changed_paths_by_key = {}
+    errors = 0
 
-    x = data[file_hash]
+    for file_hash in file_hashes:
+        try:
+            virustotal_info = get_virustotal_info(filename, file_hash)
+            assert virustotal_info is not None
+            if file_hash != virustotal_info['sha256']:
+                assert file_hash == virustotal_info['sha1']
+                file_hash = virustotal_info['sha256']
+
+            key = by_filename_storage.get_file_info_key(filename, file_hash)
+            if key not in data_by_key:
+                data_by_key[key] = load_file_info_data(key)
+
+            x = data_by_key[key][file_hash]
+
+            updated_file_info = update_file_info(x.get('fileInfo'), virustotal_info, 'vt')
+            assert updated_file_info
+            x['fileInfo'] = updated_file_info
+
+            changed_paths_by_key.setdefault(key, {})[(file_hash, 'fileInfo')] = None
+            add_hash_index_pending(filename, file_hash, x)
+        except Exception:
+            print(f'Error while processing VirusTotal data of {file_hash}')
+            traceback.print_exc()
+            errors += 1
+            continue
 
-    updated_file_info = update_file_info(x.get('fileInfo'), file_info, 'vt')
-    assert updated_file_info
-    x['fileInfo'] = updated_file_info
+    for key, changed_paths in changed_paths_by_key.items():
+        mark_file_info_data_changed(key, data_by_key[key], changed_paths)
 
-    if config.high_mem_usage_for_performance:
-        file_info_data[filename] = data
-    else:
-        output_path = output_dir.joinpath(filename + '.json.gz')
-        write_to_gzip_file(output_path, orjson.dumps(data))
+    spill_file_info_data()
+
+    return errors
 
 
-def process_virustotal_data():
-    output_dir = config.out_path.joinpath('by_filename_compressed')
-    output_dir.mkdir(parents=True, exist_ok=True)
+def add_file_info_from_virustotal_data_worker(files: list[tuple[str, list[str]]]):
+    errors = 0
+    for filename, file_hashes in files:
+        errors += add_file_info_from_virustotal_data(filename, file_hashes)
+
+    validation.flush_validated()
+
+    return errors, pop_worker_results()
+
+
+def process_virustotal_data(workers: Optional[dict[str, Any]] = None):
+    by_filename_storage.get_output_dir().mkdir(parents=True, exist_ok=True)
 
     info_progress_virustotal_path = config.out_path.joinpath('info_progress_virustotal.json')
     if info_progress_virustotal_path.is_file():
@@ -739,29 +1674,32 @@ def process_virustotal_data():
 
     pending = info_progress_virustotal.get('pending', {})
 
+    # Hashes of the same file are added together, with a single load and
+    # store of the file data.
+    pending_files = {}
+    for filename in pending:
+        file_hashes = [file_hash for file_hash in pending[filename]
+                       # Skip if was already added with one of the updates.
+                       if file_hash not in virustotal_info_added]
+        if file_hashes:
+            pending_files[filename] = file_hashes
+
     errors = 0
 
-    for filename in pending:
-        for file_hash in pending[filename]:
-            if file_hash in virustotal_info_cache:
-                # Was already added with one of the updates.
-                continue
+    if workers:
+        # Global state is not shared between processes.
+        assert file_info_data == {}
 
-            try:
-                virustotal_info = get_virustotal_info(filename, file_hash)
-                assert virustotal_info is not None
-                if file_hash != virustotal_info['sha256']:
-                    assert file_hash == virustotal_info['sha1']
-                    file_hash = virustotal_info['sha256']
-
-                add_file_info_from_virustotal_data(filename, output_dir,
-                    file_hash=file_hash,
-                    file_info=virustotal_info)
-            except Exception:
-                print(f'Error while processing VirusTotal data of {file_hash}')
-                traceback.print_exc()
-                errors += 1
-                continue
+        items = [(get_file_task_cost(filename, len(file_hashes)), filename, (filename, file_hashes))
+                 for filename, file_hashes in pending_files.items()]
+        tasks = get_worker_tasks(workers, items)
+        for _, (task_errors, worker_results) in imap_workers(
+                workers, add_file_info_from_virustotal_data_worker, tasks):
+            errors += task_errors
+            add_worker_results(worker_results)
+    else:
+        for filename, file_hashes in pending_files.items():
+            errors += add_file_info_from_virustotal_data(filename, file_hashes)
 
     if errors > 0:
         raise Exception(f'Aborting due to {errors} errors')
@@ -771,12 +1709,11 @@ def process_virustotal_data():
     with open(info_progress_virustotal_path, 'w') as f:
         json.dump(info_progress_virustotal, f, indent=0, sort_keys=True)
 
-    virustotal_info_cache.clear()
+    virustotal_info_added.clear()
 
 
 def add_file_info_from_iso_data(
     filename: str,
-    output_dir: Path,
     *,
     file_hash: str,
     file_info: dict[str, Any],
@@ -784,15 +1721,11 @@ def add_file_info_from_iso_data(
     windows_version: str,
     windows_version_info: dict[str, Any],
 ):
-    if filename in file_info_data:
-        data = file_info_data[filename]
-    else:
-        output_path = output_dir.joinpath(filename + '.json.gz')
-        if output_path.is_file():
-            with gzip.open(output_path, 'rt', encoding='utf-8') as f:
-                data = json.load(f)
-        else:
-            data = {}
+    key = by_filename_storage.get_file_info_key(filename, file_hash)
+    data = load_file_info_data(key)
+
+    if file_hash not in data:
+        by_filename_storage.add_file_info_hashes(filename, [file_hash])
 
     x = data.setdefault(file_hash, {})
 
@@ -814,62 +1747,186 @@ def add_file_info_from_iso_data(
     if source_path not in x:
         bisect.insort(x, source_path)
 
-    file_info_data[filename] = data
+    add_hash_index_pending(filename, file_hash, data[file_hash])
 
+    store_file_info_data(key, data, [
+        (file_hash, 'fileInfo'),
+        (file_hash, 'windowsVersions', windows_version, 'BASE'),
+    ])
 
-def group_iso_data_by_filename(iso_data_file: Path):
-    output_dir = config.out_path.joinpath('by_filename_compressed')
-    output_dir.mkdir(parents=True, exist_ok=True)
 
-    with open(iso_data_file) as f:
-        iso_data = json.load(f)
+def get_iso_data_bucket(filename: str):
+    digest = hashlib.sha256(filename.encode()).digest()
+    return int.from_bytes(digest[:4], 'little') % config.group_iso_data_buckets
 
-    windows_version = iso_data['windowsVersion']
-    iso_hash = iso_data['windowsIsoSha256']
-    windows_release_date = iso_data['windowsReleaseDate']
 
-    windows_version_info = {
-        'releaseDate': windows_release_date,
-        'isoSha256': iso_hash,
-    }
+def split_iso_data_by_filename(iso_data_file: Path, buckets_dir: Path):
+    # Stream the file items into bucket files by filename, so that the whole
+    # ISO data doesn't have to be in memory, and so that each bucket can be
+    # processed separately.
+    iso_data = {}
+    bucket_files = {}
+    try:
+        with open(iso_data_file, 'rb') as f:
+            builder = None
+            for prefix, event, value in ijson.parse(f, use_float=True):
+                if builder is not None:
+                    builder.event(event, value)
+                    if prefix == 'files.item' and event == 'end_map':
+                        file_item = builder.value
+                        builder = None
 
-    for file_item in iso_data['files']:
-        filename = file_item['path'].split('\\')[-1].lower()
+                        filename = file_item['path'].split('\\')[-1].lower()
 
-        source_path = file_item.pop('path')
+                        source_path = file_item.pop('path')
 
-        add_file_info_from_iso_data(filename, output_dir,
-            file_hash=file_item['sha256'],
-            file_info=file_item,
-            source_path=source_path,
-            windows_version=windows_version,
-            windows_version_info=windows_version_info)
+                        bucket = get_iso_data_bucket(filename)
+                        if bucket not in bucket_files:
+                            bucket_files[bucket] = open(buckets_dir.joinpath(f'{bucket}.jsonl'), 'wb')
+
+                        bucket_files[bucket].write(orjson.dumps([filename, source_path, file_item]) + b'\n')
+                elif prefix == 'files.item' and event == 'start_map':
+                    builder = ijson.ObjectBuilder()
+                    builder.event(event, value)
+                elif prefix in ['windowsVersion', 'windowsIsoSha256', 'windowsReleaseDate']:
+                    iso_data[prefix] = value
+    finally:
+        for bucket_file in bucket_files.values():
+            bucket_file.close()
+
+    return iso_data, [buckets_dir.joinpath(f'{bucket}.jsonl') for bucket in sorted(bucket_files)]
+
+
+def group_iso_data_bucket_by_filename(
+    bucket_path: Path,
+    windows_version: str,
+    windows_version_info: dict[str, Any],
+):
+    files = {}
+    with open(bucket_path, 'rb') as f:
+        for line in f:
+            filename, source_path, file_item = orjson.loads(line)
+            files.setdefault(filename, []).append((source_path, file_item))
+
+    for filename, file_items in files.items():
+        for source_path, file_item in file_items:
+            add_file_info_from_iso_data(filename,
+                file_hash=file_item['sha256'],
+                file_info=file_item,
+                source_path=source_path,
+                windows_version=windows_version,
+                windows_version_info=windows_version_info)
+
+
+def group_iso_data_bucket_by_filename_worker(task: tuple[Path, str, dict[str, Any]]):
+    group_iso_data_bucket_by_filename(*task)
+
+    validation.flush_validated()
+
+    return pop_worker_results()
+
+
+def group_iso_data_by_filename(iso_data_file: Path, workers: Optional[dict[str, Any]] = None):
+    by_filename_storage.get_output_dir().mkdir(parents=True, exist_ok=True)
 
+    config.temp_path.mkdir(parents=True, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=config.temp_path) as buckets_dir:
+        iso_data, bucket_paths = split_iso_data_by_filename(iso_data_file, Path(buckets_dir))
 
-def process_iso_files():
+        windows_version = iso_data['windowsVersion']
+        iso_hash = iso_data['windowsIsoSha256']
+        windows_release_date = iso_data['windowsReleaseDate']
+
+        windows_version_info = {
+            'releaseDate': windows_release_date,
+            'isoSha256': iso_hash,
+        }
+
+        tasks = [(bucket_path, windows_version, windows_version_info) for bucket_path in bucket_paths]
+
+        if workers:
+            # Global state is not shared between processes.
+            assert file_info_data == {}
+
+            # The files of a bucket aren't known, the caches of the workers
+            # were flushed before and a bucket always goes to the same worker,
+            # including for the other ISO files.
+            worker_tasks = [(int(task[0].stem) % len(workers['pools']), task) for task in tasks]
+            for _, worker_results in imap_workers(workers, group_iso_data_bucket_by_filename_worker, worker_tasks):
+                add_worker_results(worker_results)
+        else:
+            for task in tasks:
+                group_iso_data_bucket_by_filename(*task)
+
+
+def process_iso_files(workers: Optional[dict[str, Any]] = None):
     from_iso_dir = config.out_path.joinpath('from_iso')
 
-    for iso_data_file in from_iso_dir.glob('*.json'):
-        if iso_data_file.is_file():
-            print('  ' + iso_data_file.stem)
-            group_iso_data_by_filename(iso_data_file)
+    iso_data_files = [path for path in from_iso_dir.glob('*.json') if path.is_file()]
+
+    # Files are assigned to workers by bucket, their data must not be cached
+    # by other workers.
+    if workers and iso_data_files:
+        flush_workers(workers)
+
+    for iso_data_file in iso_data_files:
+        print('  ' + iso_data_file.stem)
+        group_iso_data_by_filename(iso_data_file, workers)
 
 
 def main(
     progress_state: Optional[dict[str, Any]] = None,
     time_to_stop: Optional[datetime] = None,
+    parsed_file_details: Optional[dict[str, dict[str, dict[str, list[dict[str, Any]]]]]] = None,
+    progress_file: Optional[Path] = None,
 ):
+    init_virustotal_info_index()
+    by_filename_storage.init_file_info_catalog()
+
+    # The hash index is only up to date after the run if it was before it.
+    hash_index_up_to_date = hash_index.is_hash_index_up_to_date()
+
     print('Processing data from updates')
-    process_updates(progress_state, time_to_stop)
+    processes = config.group_by_filename_processes
+    if processes > 1:
+        workers = create_workers(processes, time_to_stop)
+        try:
+            process_updates(progress_state, time_to_stop, parsed_file_details,
+                            workers=workers, progress_file=progress_file)
 
-    print('Processing data from VirusTotal')
-    process_virustotal_data()
+            print('Processing data from VirusTotal')
+            process_virustotal_data(workers)
+
+            print('Processing data from ISO files')
+            process_iso_files(workers)
+
+            flush_workers(workers)
+        finally:
+            close_workers(workers)
+    else:
+        process_updates(progress_state, time_to_stop, parsed_file_details,
+                        progress_file=progress_file)
 
-    print('Processing data from ISO files')
-    process_iso_files()
+        print('Processing data from VirusTotal')
+        process_virustotal_data()
+
+        print('Processing data from ISO files')
+        process_iso_files()
 
     write_all_file_info()
 
+    # After the data is written, as for the update index.
+    flush_hash_index()
+    if hash_index_up_to_date:
+        hash_index.set_hash_index_data_version()
+
+    validation.flush_validated()
+
+    write_counts = by_filename_storage.pop_write_counts()
+    print(f'Written files: {write_counts["written"]}, unchanged files skipped: {write_counts["skipped"]}')
+
+    print_cache_stats()
+
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,83 @@
+from typing import Optional
+import hashlib
+import sqlite3
+import orjson
+import os
+
+import config
+
+VALIDATION_LEVELS = ['full', 'sampled', 'verify_once']
+
+# Items which passed validation, recorded in the store in batches.
+validated_items: set[tuple[str, str]] = set()
+validated_items_pending: list[tuple[str, str]] = []
+
+validation_store_connection: Optional[tuple[int, sqlite3.Connection]] = None
+
+
+def get_content_key(*values):
+    return hashlib.sha256(orjson.dumps(values)).hexdigest()
+
+
+def is_sampled(kind: str, key: str):
+    digest = hashlib.sha256(f'{config.validation_sample_seed}:{kind}:{key}'.encode()).digest()
+    return int.from_bytes(digest[:8], 'little') < config.validation_sample_rate * 2**64
+
+
+def get_validation_store():
+    global validation_store_connection
+
+    # SQLite connections can't be used in forked worker processes.
+    if validation_store_connection and validation_store_connection[0] == os.getpid():
+        return validation_store_connection[1]
+
+    config.validation_store_path.parent.mkdir(parents=True, exist_ok=True)
+    connection = sqlite3.connect(config.validation_store_path, timeout=60)
+    with connection:
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('CREATE TABLE IF NOT EXISTS validated (kind TEXT, key TEXT, PRIMARY KEY (kind, key))')
+
+    validation_store_connection = (os.getpid(), connection)
+    return connection
+
+
+def should_validate(kind: str, key: str):
+    assert config.validation_level in VALIDATION_LEVELS, config.validation_level
+
+    if config.validation_level == 'full':
+        return True
+
+    if config.validation_level == 'sampled':
+        return is_sampled(kind, key)
+
+    if (kind, key) in validated_items:
+        return False
+
+    connection = get_validation_store()
+    row = connection.execute('SELECT 1 FROM validated WHERE kind = ? AND key = ?', (kind, key)).fetchone()
+    if row:
+        validated_items.add((kind, key))
+        return False
+
+    return True
+
+
+def set_validated(kind: str, key: str):
+    if config.validation_level != 'verify_once':
+        return
+
+    validated_items.add((kind, key))
+    validated_items_pending.append((kind, key))
+    if len(validated_items_pending) >= 1000:
+        flush_validated()
+
+
+def flush_validated():
+    if not validated_items_pending:
+        return
+
+    connection = get_validation_store()
+    with connection:
+        connection.executemany('INSERT OR IGNORE INTO validated VALUES (?, ?)', validated_items_pending)
+
+    validated_items_pending.clear()